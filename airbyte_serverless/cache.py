@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import hashlib
+
+
+CACHE_FOLDER = os.environ.get(
+    'ABS_CACHE_FOLDER',
+    os.path.join(os.path.expanduser('~'), '.cache', 'airbyte_serverless'),
+)
+CACHE_TTL = 7 * 24 * 3600
+
+
+def hash_content(content):
+    if not isinstance(content, (str, bytes)):
+        content = json.dumps(content, sort_keys=True, default=str)
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+class Cache:
+    '''
+    A `Cache` stores json-serializable values:
+    - in memory, for the lifetime of the instance
+    - on disk in `folder` (one file per key), for `ttl` seconds
+
+    A null or zero `ttl` disables disk caching.
+    '''
+
+    def __init__(self, folder=CACHE_FOLDER, ttl=CACHE_TTL):
+        self.folder = folder
+        self.ttl = ttl
+        self.values = {}
+
+    def _filename(self, key):
+        return os.path.join(self.folder, f'{key}.json')
+
+    def get(self, key):
+        if key in self.values:
+            return self.values[key]
+        if not self.ttl:
+            return None
+        try:
+            with open(self._filename(key), encoding='utf-8') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get('created_at', 0) > self.ttl:
+            return None
+        self.values[key] = entry['value']
+        return entry['value']
+
+    def set(self, key, value):
+        self.values[key] = value
+        if not self.ttl:
+            return
+        filename = self._filename(key)
+        temp_filename = f'{filename}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.folder, exist_ok=True)
+            with open(temp_filename, 'w', encoding='utf-8') as file:
+                json.dump({'created_at': time.time(), 'value': value}, file)
+            os.replace(temp_filename, filename)
+        except OSError as e:
+            print(f'Could not write cache file {filename}: {e}')
+
+    def delete(self, key):
+        self.values.pop(key, None)
+        try:
+            os.remove(self._filename(key))
+        except OSError:
+            pass
@@ -1,3 +1,4 @@
+import os
 import traceback
 import functools
 import sys
@@ -6,10 +7,12 @@ import shutil
 import click
 from click_help_colors import HelpColorsGroup
 
-import google.api_core.exceptions
-
 from .sources import AirbyteSourceException
-from .connections import ConnectionFromFile, ConnectionFromEnvironementVariables
+from . import runners
+from .metrics import Metrics
+from .profiler import SamplingProfiler
+from .registry import ConnectorRegistry, OFFLINE
+from .connections import ConnectionFromFile, ConnectionFromEnvironementVariables, run_connections
 
 
 
@@ -47,13 +50,16 @@ def handle_error(f):
         except (AssertionError, AirbyteSourceException) as e:
             click.echo(click.style(f'ERROR: {e}', fg='red'))
             sys.exit()
-        except google.api_core.exceptions.PermissionDenied as e:
-            click.echo(click.style(f'ERROR: PERMISSION DENIED: {e}', fg='red'))
-            sys.exit()
-        except google.api_core.exceptions.NotFound as e:
-            click.echo(click.style(f'ERROR: NOT FOUND: {e}', fg='red'))
-            sys.exit()
         except Exception as e:
+            # Google exceptions module is not imported here to keep startup fast:
+            # if a google error was raised, the module is already loaded
+            google_exceptions = sys.modules.get('google.api_core.exceptions')
+            if google_exceptions and isinstance(e, google_exceptions.PermissionDenied):
+                click.echo(click.style(f'ERROR: PERMISSION DENIED: {e}', fg='red'))
+                sys.exit()
+            if google_exceptions and isinstance(e, google_exceptions.NotFound):
+                click.echo(click.style(f'ERROR: NOT FOUND: {e}', fg='red'))
+                sys.exit()
             click.echo(click.style(f'ERROR: {e}', fg='red'))
             print(traceback.format_exc())
             sys.exit()
@@ -66,7 +72,7 @@ def handle_error(f):
 @cli.command()
 @click.argument('connection')
 @click.option('--source', default='airbyte/source-faker:0.1.4', help='Any Public Docker Airbyte Source. Example: `airbyte/source-faker:0.1.4`. (see connectors list at: "https://hub.docker.com/search?q=airbyte%2Fsource-" )')
-@click.option('--destination', default='print', help='One of `print` or `bigquery`')
+@click.option('--destination', default='print', help='One of `print`, `bigquery`, `parquet` or `duckdb`')
 @click.option('--remote-runner', default='cloud_run_job', help='`cloud_run_job` is the only valid option for now')
 @handle_error
 def create(connection, source, destination, remote_runner):
@@ -96,8 +102,20 @@ def list_available_streams(connection):
     '''
     List available streams of CONNECTION
     '''
-    connection = ConnectionFromFile(connection)
-    print_success(','.join(connection.available_streams))
+    with ConnectionFromFile(connection) as connection:
+        print_success(','.join(connection.available_streams))
+
+
+@cli.command()
+@click.argument('connection')
+@handle_error
+def refresh_catalog(connection):
+    '''
+    Refresh cached spec and catalog of CONNECTION source
+    '''
+    with ConnectionFromFile(connection) as connection:
+        catalog = connection.refresh_catalog()
+    print_success(f'Refreshed catalog of connection {connection.name}. Available streams are: ' + ','.join(stream['name'] for stream in catalog['streams']))
 
 
 @cli.command()
@@ -113,18 +131,140 @@ def set_streams(connection, streams):
     print_success(f'Successfully set streams {streams} of connection {connection.name}')
 
 
+def registry_options(f):
+    f = click.option('--refresh', is_flag=True, help='Revalidate the cached connector registry even if it is recent')(f)
+    f = click.option('--offline', is_flag=True, help='Only use the cached connector registry (can also be set with `ABS_OFFLINE=true` env var)')(f)
+    return f
+
+
+def get_registry(offline, refresh):
+    registry = ConnectorRegistry(offline=offline or OFFLINE)
+    registry.refresh(force=refresh)
+    return registry
+
+
+@cli.command()
+@click.argument('text', required=False, default='')
+@registry_options
+@handle_error
+def search_connectors(text, offline, refresh):
+    '''
+    Search Airbyte sources whose name contains TEXT in the connector registry
+    '''
+    connectors = get_registry(offline, refresh).search(text)
+    print_color('\n'.join(
+        [f'{"CONNECTOR":<45} {"VERSION":<12} {"PYPI PACKAGE":<45} INCREMENTAL'] +
+        [
+            f'{connector["name"]:<45} {connector["docker_image_tag"] or "":<12} {connector["pypi_package"] or "-":<45} {connector["supports_incremental"] if connector["supports_incremental"] is not None else "-"}'
+            for connector in connectors
+        ]
+    ))
+    print_success(f'Found {len(connectors)} connector(s)')
+
+
 @cli.command()
 @click.argument('connection')
+@click.argument('version', required=False)
+@registry_options
+@handle_error
+def pin_source_version(connection, version, offline, refresh):
+    '''
+    Pin the source of CONNECTION (docker image or PyPI package) to VERSION (latest version of the connector registry by default)
+    '''
+    connection = ConnectionFromFile(connection)
+    registry = get_registry(offline, refresh) if not version else None
+    source = connection.set_source_version(version, registry=registry)
+    print_success(f'Pinned source of connection {connection.name} to `{source}`')
+
+
+def print_results(results):
+    print_color('\n'.join(
+        [f'{"CONNECTION":<40} {"STATUS":<8} {"DURATION":>10} {"RECORDS":>12}  ERROR'] +
+        [
+            f'{result["connection"]:<40} {result["status"]:<8} {result["duration"]:>9.1f}s {result["records"]:>12}  {result["error"] or ""}'
+            for result in results
+        ]
+    ))
+    failed = [result['connection'] for result in results if result['status'] != 'OK']
+    assert not failed, f'{len(failed)} connection(s) failed: {", ".join(failed)}'
+    print_success(f'{len(results)} connection(s) ran successfully')
+
+
+def run_connections_from_files(connections, workers, max_per_destination, max_per_source):
+    connections = [ConnectionFromFile(connection.strip()) for connection in connections if connection.strip()]
+    assert connections, 'No connection to run'
+    try:
+        results = run_connections(
+            connections,
+            workers=workers,
+            max_per_destination=max_per_destination,
+            max_per_source=max_per_source,
+        )
+    finally:
+        for connection in connections:
+            connection.close()
+    print_results(results)
+
+
+def pool_options(f):
+    f = click.option('--max-per-source', default=None, type=int, help='Maximum number of connections running at the same time with a same source image or executable (no limit by default)')(f)
+    f = click.option('--max-per-destination', default=None, type=int, help='Maximum number of connections running at the same time on a same destination dataset, folder or database (no limit by default)')(f)
+    f = click.option('--workers', default=4, help='Number of connections running at the same time')(f)
+    return f
+
+
+def save_profile(profiler, folder, gcs_prefix=None):
+    print_color(profiler.report(top=15))
+    filenames = profiler.save(folder, gcs_prefix=gcs_prefix)
+    print_info('Profile written to ' + ', '.join(filenames))
+
+
+@cli.command()
+@click.argument('connection', required=False)
+@click.option('--parallel', default='', help='Comma-separated list of connections to run concurrently (instead of CONNECTION)')
+@click.option('--metrics-textfile', default='', help='File where metrics of the run are written in Prometheus text format (for node exporter textfile collector)')
+@click.option('--metrics-port', default=None, type=int, help='If set, metrics of the run are exposed in Prometheus format at `http://localhost:PORT/metrics` during the run')
+@click.option('--profile', is_flag=True, help='Profile the run with a sampling profiler. A speedscope file (to open on https://www.speedscope.app) and a report of hot functions are written in `--profile-folder`')
+@click.option('--profile-folder', default='profiles', help='Folder where profiles are written')
+@pool_options
 @handle_error
-def run(connection):
+def run(connection, parallel, workers, max_per_destination, max_per_source, metrics_textfile, metrics_port, profile, profile_folder):
     '''
     Run CONNECTION Extract-Load Job
     '''
+    if parallel:
+        run_connections_from_files(parallel.split(','), workers, max_per_destination, max_per_source)
+        return
+    assert connection, 'CONNECTION argument or `--parallel` option must be given'
     connection = ConnectionFromFile(connection)
-    connection.run()
+    metrics = Metrics()
+    if metrics_port:
+        metrics.serve(metrics_port)
+        print_info(f'Metrics are exposed at http://localhost:{metrics_port}/metrics')
+    profiler = SamplingProfiler() if profile else None
+    try:
+        connection.run(metrics=metrics, profiler=profiler)
+    finally:
+        connection.close()
+        if metrics_textfile:
+            metrics.write_textfile(metrics_textfile)
+        if profiler is not None:
+            save_profile(profiler, profile_folder)
     print_success('OK')
 
 
+@cli.command()
+@click.option('--connections', default='', help='Comma-separated list of connections to run. If empty, all connections are run')
+@pool_options
+@handle_error
+def run_all(connections, workers, max_per_destination, max_per_source):
+    '''
+    Run Extract-Load Jobs of all connections concurrently
+    '''
+    connections = connections.split(',') if connections else ConnectionFromFile.list_connections()
+    run_connections_from_files(connections, workers, max_per_destination, max_per_source)
+
+
 @cli.command()
 @click.argument('connection')
 @handle_error
@@ -132,11 +272,44 @@ def remote_run(connection):
     '''
     Run CONNECTION Extract-Load Job from remote runner
     '''
-    connection = ConnectionFromFile(connection)
-    connection.remote_run()
+    with ConnectionFromFile(connection) as connection:
+        connection.remote_run()
     print_success('OK')
 
 
+@cli.command()
+@click.argument('connection')
+@click.option('--tag', default='', help='Tag of the image (such as `REGION-docker.pkg.dev/PROJECT/REPOSITORY/IMAGE:TAG` to be used by Cloud Run). Defaults to `abs-CONNECTION`')
+@click.option('--build/--no-build', default=True, help='Build the image with docker (else only generate the Dockerfile)')
+@click.option('--push', is_flag=True, help='Push the image once built. The image is only recorded as `runner_image` of CONNECTION if built and pushed')
+@handle_error
+def build_runner_image(connection, tag, build, push):
+    '''
+    Build an image for CONNECTION remote runs with airbyte_serverless already installed
+    '''
+    connection = ConnectionFromFile(connection)
+    source_image = connection.config['source'].get('docker_image')
+    assert source_image, 'Runner images can only be built for connections with a `docker_image` source'
+    tag = tag or f'abs-{connection.name}'.lower().replace('_', '-')
+    assert not push or runners.is_registry_image(tag), (
+        f'`{tag}` is not a registry path and cannot be pushed. '
+        'Please set `--tag` like `REGION-docker.pkg.dev/PROJECT/REPOSITORY/IMAGE:TAG`'
+    )
+    folder = runners.generate_runner_image_context(source_image, f'runner_images/{connection.name}')
+    print_info(f'Generated Dockerfile in {folder}')
+    if build:
+        runners.build_runner_image(folder, tag, push=push)
+    if not (build and push):
+        # Cloud Run could not pull the image: next remote runs would fail
+        print_warning(
+            f'Runner image `{tag}` was not {"built and " if not build else ""}pushed: '
+            f'it is not recorded in connection {connection.name}. Use `--push` with a registry `--tag` to record it'
+        )
+        return
+    connection.set_runner_image(tag)
+    print_success(f'Set runner image `{tag}` in connection {connection.name}')
+
+
 @cli.command()
 @handle_error
 def run_env_vars():
@@ -144,5 +317,12 @@ def run_env_vars():
     Run Extract-Load Job configured by environment variables
     '''
     connection = ConnectionFromEnvironementVariables()
-    connection.run()
+    profile = os.environ.get('ABS_PROFILE', '').lower() in ['1', 'true', 'yes']
+    profiler = SamplingProfiler() if profile else None
+    try:
+        connection.run(profiler=profiler)
+    finally:
+        connection.close()
+        if profiler is not None:
+            save_profile(profiler, os.environ.get('ABS_PROFILE_FOLDER', 'profiles'), os.environ.get('ABS_PROFILE_GCS_PREFIX'))
     print_success('OK')
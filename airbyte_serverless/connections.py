@@ -1,16 +1,20 @@
 import os
 import re
+import copy
+import json
+import time
 import base64
-
-import yaml
-import jinja2
+import threading
+import traceback
+import collections
 
 from .sources import Source
 from .destinations import Destination
 from .runners import Runner
+from .registry import pin_source_version
 
 
-CONNECTION_CONFIG_TEMPLATE = jinja2.Template('''
+CONNECTION_CONFIG_TEMPLATE = '''
 source:
   {{ source.yaml_definition_example | indent(2, False) }}
 
@@ -19,7 +23,7 @@ destination:
 
 remote_runner:
   {{ remote_runner.yaml_definition_example | indent(2, False) }}
-''')
+'''
 
 
 SECRETS = {}
@@ -45,10 +49,19 @@ class Connection:
     A `Connection` instance:
     - instantiates a `source` and a `destination` from provided `yaml_config`
     - has a `run` method to perform extract-load from `source` to `destination`
+
+    `yaml_config` is parsed once (secrets included) into a snapshot which is only rebuilt when
+    `yaml_config` changes. `source`, `destination` and `remote_runner` are built once per snapshot
+    so that their temporary directories and clients are reused. Use `close` (or a `with` block)
+    to clean them up.
     '''
 
+    _snapshot = None  # (yaml_config, config, {name: object built from config})
+    _stale_objects = ()  # Objects built from previous snapshots, cleaned up at `close`
+
     def __init__(self, yaml_config=None):
         if isinstance(yaml_config, dict):
+            import yaml
             yaml_config = yaml.dump(yaml_config)
         self.yaml_config = yaml_config
 
@@ -56,41 +69,111 @@ class Connection:
         source = Source(source)
         destination = Destination(destination)
         remote_runner = Runner(remote_runner, self)
-        self.yaml_config = CONNECTION_CONFIG_TEMPLATE.render(
-            source=source,
-            destination=destination,
-            remote_runner=remote_runner,
-        )
+        import jinja2
+        try:
+            self.yaml_config = jinja2.Template(CONNECTION_CONFIG_TEMPLATE).render(
+                source=source,
+                destination=destination,
+                remote_runner=remote_runner,
+            )
+        finally:
+            source.close()
+
+    def _get_snapshot(self):
+        yaml_config = self.yaml_config
+        if self._snapshot is None or self._snapshot[0] != yaml_config:
+            assert yaml_config, 'connection `yaml_config` does not exist. Please re-create connection'
+            import yaml
+            config = yaml.safe_load(replace_secrets(yaml_config))
+            if self._snapshot is not None:
+                # Not closed now since they may still be used by a running extract-load
+                self._stale_objects += tuple(self._snapshot[2].values())
+            self._snapshot = (yaml_config, config, {})
+        return self._snapshot
 
     @property
     def config(self):
-        yaml_config = self.yaml_config
-        yaml_config = replace_secrets(yaml_config)
-        assert yaml_config, 'connection `yaml_config` does not exist. Please re-create connection'
-        return yaml.safe_load(yaml_config)
+        # A copy so that callers cannot alter the snapshot
+        return copy.deepcopy(self._get_snapshot()[1])
+
+    def _get_object(self, name, build):
+        _, config, objects = self._get_snapshot()
+        if name not in objects:
+            objects[name] = build(copy.deepcopy(config))
+        return objects[name]
+
+    def close(self):
+        '''
+        Clean up temporary directories and connections of source and destination
+        '''
+        objects = list(self._stale_objects)
+        if self._snapshot is not None:
+            objects += self._snapshot[2].values()
+            self._snapshot[2].clear()
+        self._stale_objects = ()
+        for obj in objects:
+            if isinstance(obj, (Source, Destination)):
+                obj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     @property
     def available_streams(self):
         return self.source.available_streams
 
+    def refresh_catalog(self):
+        return self.source.refresh_catalog()
+
     def set_streams(self, streams):
         assert streams, '`streams` variable must be defined'
         self.yaml_config = re.sub(r'streams:[^#]*(#*.*)', f'streams: {streams} \g<1>', self.yaml_config)
 
+    def set_source_version(self, version=None, registry=None):
+        '''
+        Pin the source connector to `version` (latest version of the connector `registry` if None)
+        '''
+        source = self.config['source']
+        key = next((key for key in ['docker_image', 'executable', 'docker_image_or_executable'] if source.get(key)), None)
+        assert key, '`source` section must have a `docker_image` or an `executable`'
+        pinned_source = pin_source_version(source[key], version, registry=registry)
+        self.yaml_config = re.sub(
+            rf'({key}:\s*["\']?){re.escape(source[key])}',
+            lambda match: match.group(1) + pinned_source,
+            self.yaml_config,
+            count=1,
+        )
+        return pinned_source
+
+    def set_runner_image(self, runner_image):
+        assert runner_image, '`runner_image` variable must be defined'
+        if re.search(r'^\s+runner_image:', self.yaml_config, flags=re.MULTILINE):
+            self.yaml_config = re.sub(r'runner_image:[^#\n]*', f'runner_image: "{runner_image}" ', self.yaml_config)
+        else:
+            self.yaml_config = re.sub(
+                r'(remote_runner:\s*\n(?:.*\n)*?\s*config:.*\n)',
+                f'\\g<1>    runner_image: "{runner_image}"\n',
+                self.yaml_config,
+            )
+        assert 'runner_image:' in self.yaml_config, '`remote_runner` section with a `config` field is missing in connection yaml file'
+
     @property
     def source(self):
-        return Source(**self.config['source'])
+        return self._get_object('source', lambda config: Source(**config['source']))
 
     @property
     def destination(self):
-        return Destination(**self.config['destination'])
+        return self._get_object('destination', lambda config: Destination(**config['destination']))
 
     @property
     def remote_runner(self):
-        return Runner(self.config['remote_runner']['type'], self)
+        return self._get_object('remote_runner', lambda config: Runner(config['remote_runner']['type'], self))
 
-    def run(self, state=None):
-        Runner('direct', self).run(state=state)
+    def run(self, state=None, pipelined=True, metrics=None, profiler=None):
+        return Runner('direct', self).run(state=state, pipelined=pipelined, metrics=metrics, profiler=profiler)
 
     def remote_run(self):
         self.remote_runner.run()
@@ -108,6 +191,8 @@ class ConnectionFromFile(Connection):
     def __init__(self, name):
         self.name = name
         self.config_filename = f'{self.CONNECTIONS_FOLDER}/{self.name}.yaml'
+        self._file_version = None  # (mtime, size) of config file when it was last read
+        self._file_content = ''
 
     def init_yaml_config(self, source, destination, remote_runner):
         assert not self.yaml_config, (
@@ -117,16 +202,32 @@ class ConnectionFromFile(Connection):
         )
         super().init_yaml_config(source, destination, remote_runner)
 
+    def _get_file_version(self):
+        try:
+            stat = os.stat(self.config_filename)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
     @property
     def yaml_config(self):
-        if not os.path.isfile(self.config_filename):
+        # Config file is only read again when it was modified
+        file_version = self._get_file_version()
+        if file_version is None:
             return ''
-        return open(self.config_filename, encoding='utf-8').read()
+        if file_version != self._file_version:
+            with open(self.config_filename, encoding='utf-8') as file:
+                self._file_content = file.read()
+            self._file_version = file_version
+        return self._file_content
 
     @yaml_config.setter
     def yaml_config(self, yaml_config):
         os.makedirs(self.CONNECTIONS_FOLDER, exist_ok=True)
-        return open(self.config_filename, 'w', encoding='utf-8').write(yaml_config)
+        with open(self.config_filename, 'w', encoding='utf-8') as file:
+            file.write(yaml_config)
+        self._file_content = yaml_config
+        self._file_version = self._get_file_version()
 
     @classmethod
     def list_connections(cls):
@@ -137,9 +238,94 @@ class ConnectionFromFile(Connection):
         ]
 
 
+def get_source_key(config):
+    source = config['source']
+    return source.get('docker_image') or source.get('executable') or source.get('docker_image_or_executable')
+
+
+def get_destination_key(config):
+    destination = config['destination']
+    destination_config = destination.get('config') or {}
+    location = destination_config.get('dataset') or destination_config.get('folder') or destination_config.get('database') or ''
+    return f"{destination['connector']}:{location}"
+
+
+def run_connections(connections, workers=4, max_per_destination=None, max_per_source=None):
+    '''
+    Run `connections` concurrently with a pool of `workers` threads.
+
+    At most `max_per_destination` connections run at the same time on a same destination
+    (i.e. BigQuery dataset, folder or database) and at most `max_per_source`
+    with a same source image or executable (no limit if None).
+
+    Return one result dict per connection with its `status`, `duration`, `records` count and `error`.
+    '''
+    pending = []
+    results = []
+    for connection in connections:
+        result = {'connection': connection.name, 'status': 'PENDING', 'duration': 0, 'records': 0, 'error': None}
+        results.append(result)
+        try:
+            config = connection.config
+            pending.append((connection, result, get_source_key(config), get_destination_key(config)))
+        except Exception as e:
+            result.update(status='FAILED', error=str(e))
+    running_per_source = collections.Counter()
+    running_per_destination = collections.Counter()
+    condition = threading.Condition()
+
+    def can_run(source_key, destination_key):
+        return (
+            (not max_per_source or running_per_source[source_key] < max_per_source) and
+            (not max_per_destination or running_per_destination[destination_key] < max_per_destination)
+        )
+
+    def get_next():
+        with condition:
+            while pending:
+                for item in pending:
+                    _, _, source_key, destination_key = item
+                    if can_run(source_key, destination_key):
+                        pending.remove(item)
+                        running_per_source[source_key] += 1
+                        running_per_destination[destination_key] += 1
+                        return item
+                condition.wait()
+            return None
+
+    def work():
+        while True:
+            item = get_next()
+            if item is None:
+                return
+            connection, result, source_key, destination_key = item
+            start = time.monotonic()
+            try:
+                result['records'] = connection.run()
+                result['status'] = 'OK'
+            except Exception as e:
+                result['status'] = 'FAILED'
+                result['error'] = str(e)
+                print(f'Connection `{connection.name}` failed:\n{traceback.format_exc()}')
+            finally:
+                result['duration'] = time.monotonic() - start
+                with condition:
+                    running_per_source[source_key] -= 1
+                    running_per_destination[destination_key] -= 1
+                    condition.notify_all()
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(max(1, min(workers, len(pending))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
 class ConnectionFromEnvironementVariables(Connection):
 
     def __init__(self):
+        import yaml
         yaml_config_b64 = os.environ.get('YAML_CONFIG')
         assert yaml_config_b64, 'YAML_CONFIG environment variable is not set'
         yaml_config = base64.b64decode(yaml_config_b64.encode('utf-8')).decode('utf-8')
@@ -149,4 +335,36 @@ class ConnectionFromEnvironementVariables(Connection):
             executable = os.environ.get('AIRBYTE_ENTRYPOINT')
             assert executable, 'AIRBYTE_ENTRYPOINT environment variable is not set'
             yaml_config['source']['executable'] = executable
+        catalog_b64 = os.environ.get('AIRBYTE_CATALOG')
+        if catalog_b64:
+            yaml_config['source']['catalog'] = json.loads(base64.b64decode(catalog_b64.encode('utf-8')).decode('utf-8'))
+        self.has_streams = True
+        self.yaml_config = yaml.dump(yaml_config)
+        task_count = int(os.environ.get('CLOUD_RUN_TASK_COUNT', 1))
+        if task_count > 1:
+            self._select_task_streams(yaml_config, int(os.environ.get('CLOUD_RUN_TASK_INDEX', 0)), task_count)
+
+    def _select_task_streams(self, yaml_config, task_index, task_count):
+        '''
+        When the job is run by several Cloud Run tasks, keep only the share of streams of this task
+        '''
+        import yaml
+        # Source of the snapshot so that streams are discovered with secrets replaced
+        # Sorted since each task discovers the catalog and streams may not come in the same order
+        streams = sorted(stream['stream']['name'] for stream in self.source.configured_catalog['streams'])
+        catalog = self.source.catalog
+        self.close()
+        task_streams = streams[task_index::task_count]
+        print(f'Task {task_index + 1}/{task_count} extracts streams: {task_streams}')
+        yaml_config['source']['catalog'] = catalog  # Discovered once
+        yaml_config['source']['streams'] = ','.join(task_streams)
+        # States of a task must not overwrite states of streams of other tasks
+        yaml_config['source']['stream_states_only'] = True
+        self.has_streams = bool(task_streams)
         self.yaml_config = yaml.dump(yaml_config)
+
+    def run(self, state=None, pipelined=True, metrics=None, profiler=None):
+        if not self.has_streams:
+            print('No stream to extract for this task')
+            return 0
+        return super().run(state=state, pipelined=pipelined, metrics=metrics, profiler=profiler)
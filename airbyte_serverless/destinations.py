@@ -1,6 +1,106 @@
+import os
+import re
 import json
+import gzip
+import time
+import tempfile
 import datetime
 import uuid
+import threading
+
+from .messages import RawJson, to_raw_json
+from .metrics import Metrics, SIZE_BUCKETS
+
+
+def get_json_string_size(data):
+    '''
+    Return the size of `data` (json as bytes) once serialized as an ascii json string,
+    as `_airbyte_data` in the body of BigQuery `insert_all` requests (quotes and non ascii characters are escaped)
+    '''
+    if data.isascii():
+        return len(data) + 2 + data.count(b'"') + data.count(b'\\')
+    return len(json.dumps(data.decode('utf-8')))
+
+
+class Buffer:
+    '''
+    Records waiting to be written, with their size in requests and age
+    '''
+
+    row_size_overhead = 370  # Size of insert id and `_airbyte_*` metadata columns of a record in `insert_all` requests
+
+    def __init__(self):
+        self.records = []
+        self.size = 0
+        self.created_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.records)
+
+    def append(self, record):
+        data = record['data'] = to_raw_json(record['data'])
+        self.records.append(record)
+        self.size += get_json_string_size(data) + self.row_size_overhead
+
+    @property
+    def age(self):
+        return time.monotonic() - self.created_at
+
+
+def get_latest_state(states):
+    '''
+    Return the state to give to the source from `states`,
+    an iterable of (state, loaded_at) written in `_airbyte_states`.
+
+    Follows the same precedence as `BigQueryDestination._get_state_from_history`: the most recent among
+    latest STREAM states (one per stream), latest GLOBAL state and latest legacy state.
+    '''
+    stream_states = {}
+    global_state = None
+    legacy_state = None
+    for state, loaded_at in states:
+        if state.get('type') == 'STREAM':
+            stream = state.get('stream', {}).get('stream_descriptor', {}).get('name')
+            if stream not in stream_states or loaded_at > stream_states[stream][1]:
+                stream_states[stream] = (state, loaded_at)
+        elif state.get('type') == 'GLOBAL':
+            if global_state is None or loaded_at > global_state[1]:
+                global_state = (state, loaded_at)
+        elif state.get('data') is not None:
+            if legacy_state is None or loaded_at > legacy_state[1]:
+                legacy_state = (state['data'], loaded_at)
+    candidates = []
+    if stream_states:
+        candidates.append((
+            [state for state, _ in stream_states.values()],
+            max(loaded_at for _, loaded_at in stream_states.values()),
+        ))
+    if global_state:
+        candidates.append(([global_state[0]], global_state[1]))
+    if legacy_state:
+        candidates.append(legacy_state)
+    if not candidates:
+        return {}
+    return max(candidates, key=lambda candidate: candidate[1])[0]
+
+
+def get_state_key(state):
+    '''
+    Return the key under which `state` replaces previous states: one per stream for STREAM states
+    '''
+    if state.get('type') == 'STREAM':
+        return 'STREAM:' + str(state.get('stream', {}).get('stream_descriptor', {}).get('name'))
+    if state.get('type') == 'GLOBAL':
+        return 'GLOBAL'
+    return 'LEGACY'
+
+
+def columns_to_rows(columns):
+    '''
+    Return records as a list of dicts from `columns`, a dict of lists of values
+    '''
+    names = list(columns)
+    return [dict(zip(names, values)) for values in zip(*columns.values())]
 
 
 class BaseDestination:
@@ -16,80 +116,153 @@ class BaseDestination:
 
     yaml_definition_example = '\n'.join([
         'buffer_size_max: 10000 # OPTIONAL | integer | maximum number of records in buffer before writing to destination (defaults to 10000 when not specified)',
+        'buffer_bytes_max: 7000000 # OPTIONAL | integer | maximum size in bytes of records in buffer before writing to destination, counted as in BigQuery requests where records are escaped json strings (defaults to 7000000 when not specified, to stay under BigQuery 10MB request limit)',
+        'buffer_age_max: 60 # OPTIONAL | number | maximum number of seconds records can stay in buffer before writing to destination (defaults to 60 when not specified)',
     ])
 
-    def __init__(self, buffer_size_max=10000):
+    columnar = False  # If True, `_write` receives records as a dict of columns instead of a list of dicts
+
+    def __init__(self, buffer_size_max=10000, buffer_bytes_max=7000000, buffer_age_max=60):
         self.buffer_size_max = buffer_size_max
+        self.buffer_bytes_max = buffer_bytes_max
+        self.buffer_age_max = buffer_age_max
 
     def get_state(self):
         raise NotImplementedError()
 
+    def close(self):
+        '''
+        Release files and connections held by the destination
+        '''
+        pass
+
     def get_logs(self):
         raise NotImplementedError()
 
-    def load(self, messages):
+    def load(self, messages, configured_catalog=None, metrics=None):
+        self.configured_catalog = configured_catalog or {'streams': []}
+        self.metrics = metrics or Metrics()
         self.job_started_at = datetime.datetime.utcnow().isoformat()
         self.slice_started_at = self.job_started_at
-        buffer = []
-        stream = None
+        self.records_count = 0
+        buffers = {}  # One buffer per stream so that interleaved streams do not cause tiny writes
+        next_age_check = time.monotonic() + 1
         for message in messages:
+            if time.monotonic() >= next_age_check:
+                self._write_buffers(buffers, age_min=self.buffer_age_max)
+                next_age_check = time.monotonic() + 1
             if message['type'] == 'RECORD':
-                new_stream = message['record']['stream']
-                if new_stream != stream and stream is not None:
-                    self._format_and_write(f'_airbyte_raw_{stream}', buffer)
-                    buffer = []
-                    self.slice_started_at = datetime.datetime.utcnow().isoformat()
-                stream = new_stream
+                self.records_count += 1
+                stream = message['record']['stream']
+                buffer = buffers.get(stream)
+                if buffer is None:
+                    buffer = buffers[stream] = Buffer()
                 buffer.append(message['record'])
-                if len(buffer) > self.buffer_size_max:
-                    self._format_and_write(f'_airbyte_raw_{stream}', buffer)
-                    buffer = []
+                if len(buffer) >= self.buffer_size_max or buffer.size >= self.buffer_bytes_max:
+                    self._format_and_write(f'_airbyte_raw_{stream}', buffers.pop(stream).records)
             elif message['type'] == 'STATE':
-                self._format_and_write(f'_airbyte_raw_{stream}', buffer)
-                buffer = []
+                received_at = time.perf_counter()
+                # All records emitted before the state must be written before the state
+                self._write_buffers(buffers)
+                with self.metrics.timer('commit_seconds'):
+                    self._commit()
                 self._format_and_write('_airbyte_states', [message['state']])
+                self.metrics.observe('state_commit_lag_seconds', time.perf_counter() - received_at)
                 self.slice_started_at = datetime.datetime.utcnow().isoformat()
             elif message['type'] == 'LOG':
                 print(message['log'])
                 self._format_and_write('_airbyte_logs', [message['log']])
-            elif message['type'] == 'CONTROL':
+            elif message['type'] in ['CONTROL', 'TICK']:
                 pass
             elif message['type'] == 'TRACE':
                 self._format_and_write('_airbyte_logs', [message['trace']])
             else:
                 raise NotImplementedError(f'message type {message["type"]} is not managed yet')
-        self._format_and_write(f'_airbyte_raw_{stream}', buffer)
+        self._write_buffers(buffers)
+        with self.metrics.timer('commit_seconds'):
+            self._commit()
+
+    def write_metrics(self):
+        '''
+        Print metrics summary of last `load` and write it to `_airbyte_logs`
+        '''
+        summary = self.metrics.summary()
+        print('METRICS:', json.dumps(summary))
+        self._format_and_write('_airbyte_logs', [{'type': 'METRICS', 'metrics': summary}])
+
+    def _write_buffers(self, buffers, age_min=0):
+        for stream, buffer in list(buffers.items()):
+            if buffer.age >= age_min:
+                self._format_and_write(f'_airbyte_raw_{stream}', buffer.records)
+                del buffers[stream]
 
     def _format_and_write(self, record_type, records):
         if not records:
             return
-        records = self._format(record_type, records)
-        self._write(record_type, records)
+        start = time.perf_counter()
+        columns = self._format_columns(record_type, records)
+        formatted_records = columns if self.columnar else columns_to_rows(columns)
+        formatted_at = time.perf_counter()
+        self._write(record_type, formatted_records)
+        metrics = self.metrics
+        metrics.increment('format_seconds', formatted_at - start, table=record_type)
+        metrics.observe('write_seconds', time.perf_counter() - formatted_at, table=record_type)
+        metrics.observe('batch_records', len(records), buckets=SIZE_BUCKETS, table=record_type)
+        if record_type.startswith('_airbyte_raw_'):
+            stream = record_type[len('_airbyte_raw_'):]
+            metrics.increment('records', len(records), stream=stream)
+            metrics.increment('record_bytes', sum(len(record['data']) for record in records), stream=stream)
 
     def _format(self, record_type, records):
-        now  = datetime.datetime.utcnow().isoformat()
-        return [
-            {
-                '_airbyte_raw_id': str(uuid.uuid4()),
-                '_airbyte_job_started_at': self.job_started_at,
-                '_airbyte_slice_started_at': self.slice_started_at,
-                '_airbyte_extracted_at': (
-                    datetime.datetime.fromtimestamp(record['emitted_at'] / 1000).isoformat()
-                    if 'emitted_at' in record
-                    else None
-                ),
-                '_airbyte_loaded_at': now,
-                '_airbyte_data': json.dumps(
-                    record['data'] if record_type.startswith('_airbyte_raw') else record,
-                    ensure_ascii=False
-                ),
-            }
-            for record in records
-        ]
+        return columns_to_rows(self._format_columns(record_type, records))
+
+    def _format_columns(self, record_type, records):
+        '''
+        Format a whole batch of records as a dict of columns (lists of values).
+        Values shared by all records are computed once.
+        '''
+        count = len(records)
+        now = datetime.datetime.utcnow().isoformat()
+        is_raw_record = record_type.startswith('_airbyte_raw')
+        # Raw ids are one random uuid prefix per batch followed by the record index in batch
+        id_prefix = uuid.uuid4().hex
+        id_prefix = f'{id_prefix[:8]}-{id_prefix[8:12]}-{id_prefix[12:16]}-{id_prefix[16:20]}-'
+        extracted_at = {None: None}  # emitted_at --> extracted_at (records of a batch often share it)
+        for record in records:
+            emitted_at = record.get('emitted_at')
+            if emitted_at not in extracted_at:
+                extracted_at[emitted_at] = datetime.datetime.fromtimestamp(emitted_at / 1000).isoformat()
+        serialize = self._serialize
+        return {
+            '_airbyte_raw_id': [f'{id_prefix}{index:012x}' for index in range(count)],
+            '_airbyte_job_started_at': [self.job_started_at] * count,
+            '_airbyte_slice_started_at': [self.slice_started_at] * count,
+            '_airbyte_extracted_at': [extracted_at[record.get('emitted_at')] for record in records],
+            '_airbyte_loaded_at': [now] * count,
+            '_airbyte_data': (
+                [serialize(record['data']) for record in records]
+                if is_raw_record
+                else [serialize(record) for record in records]
+            ),
+        }
+
+    @staticmethod
+    def _serialize(data):
+        if isinstance(data, RawJson):
+            return data.decode('utf-8')
+        return json.dumps(data, ensure_ascii=False)
 
     def _write(self, record_type, records):
         raise NotImplementedError()
 
+    def _commit(self):
+        '''
+        Called at checkpoints (and at the end of the job) once all records emitted before
+        have been given to `_write`. Destinations which do not write records immediately
+        must make them durable here: the state is written just after.
+        '''
+        pass
+
 
 class PrintDestination(BaseDestination):
 
@@ -103,24 +276,396 @@ class PrintDestination(BaseDestination):
             print(json.dumps(record))
 
 
+class BigQueryStorageWriter:
+    '''
+    Write formatted records with BigQuery Storage Write API.
+
+    One pending stream is kept open per table with a long-lived `AppendRowsStream` connection
+    (which sends the routing header of the write stream). Appends are sent without waiting
+    for their responses (at most `max_in_flight` per table). Appended rows become visible only
+    when `commit` is called: responses are then checked and all pending streams are finalized
+    and committed so that the rows of a slice land atomically.
+
+    `write_client` must be a `google.cloud.bigquery_storage_v1.BigQueryWriteClient`.
+    '''
+
+    def __init__(self, write_client, columns, append_rows_stream_class=None, max_in_flight=20):
+        from google.cloud.bigquery_storage_v1 import types, writer
+        from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+        self.write_client = write_client
+        self.types = types
+        self.append_rows_stream_class = append_rows_stream_class or writer.AppendRowsStream
+        self.max_in_flight = max_in_flight
+        self.columns = columns
+        self.timestamp_columns = [column for column, type, _ in columns if type == 'timestamp']
+        descriptor_proto = descriptor_pb2.DescriptorProto(name='AirbyteRow')
+        for number, (column, type, _) in enumerate(columns, start=1):
+            descriptor_proto.field.add(
+                name=column,
+                number=number,
+                type=(
+                    descriptor_pb2.FieldDescriptorProto.TYPE_INT64
+                    if type == 'timestamp'
+                    else descriptor_pb2.FieldDescriptorProto.TYPE_STRING
+                ),
+                label=descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL,
+            )
+        file_proto = descriptor_pb2.FileDescriptorProto(name='airbyte_row.proto', package='airbyte_serverless')
+        file_proto.message_type.add().CopyFrom(descriptor_proto)
+        pool = descriptor_pool.DescriptorPool()
+        pool.Add(file_proto)
+        self.row_class = message_factory.GetMessageClass(pool.FindMessageTypeByName('airbyte_serverless.AirbyteRow'))
+        self.proto_schema = types.ProtoSchema(proto_descriptor=descriptor_proto)
+        self.streams = {}  # table path --> {'name', 'offset' of next row, 'connection': AppendRowsStream, 'futures' of sent appends}
+
+    @staticmethod
+    def _to_microseconds(timestamp, cache):
+        if timestamp not in cache:
+            cache[timestamp] = int(
+                datetime.datetime.fromisoformat(timestamp)
+                .replace(tzinfo=datetime.timezone.utc)
+                .timestamp() * 1_000_000
+            )
+        return cache[timestamp]
+
+    def _serialize(self, records):
+        timestamps = {}
+        serialized_rows = []
+        for record in records:
+            row = dict(record)
+            for column in self.timestamp_columns:
+                if row.get(column) is not None:
+                    row[column] = self._to_microseconds(row[column], timestamps)
+                else:
+                    row.pop(column, None)
+            serialized_rows.append(self.row_class(**row).SerializeToString())
+        return serialized_rows
+
+    def append(self, table_path, records):
+        if table_path not in self.streams:
+            write_stream = self.write_client.create_write_stream(
+                parent=table_path,
+                write_stream=self.types.WriteStream(type_=self.types.WriteStream.Type.PENDING),
+            )
+            # Stream name and schema are only sent with the first request of the connection
+            connection = self.append_rows_stream_class(
+                self.write_client,
+                self.types.AppendRowsRequest(
+                    write_stream=write_stream.name,
+                    proto_rows=self.types.AppendRowsRequest.ProtoData(writer_schema=self.proto_schema),
+                ),
+            )
+            self.streams[table_path] = {'name': write_stream.name, 'offset': 0, 'connection': connection, 'futures': []}
+        stream = self.streams[table_path]
+        request = self.types.AppendRowsRequest(
+            offset=stream['offset'],
+            proto_rows=self.types.AppendRowsRequest.ProtoData(
+                rows=self.types.ProtoRows(serialized_rows=self._serialize(records)),
+            ),
+        )
+        stream['futures'].append(stream['connection'].send(request))
+        stream['offset'] += len(records)
+        while len(stream['futures']) > self.max_in_flight:
+            self._check_response(table_path, stream['futures'].pop(0))
+
+    @staticmethod
+    def _check_response(table_path, future):
+        try:
+            response = future.result()
+        except Exception as e:
+            raise ValueError(f'Could not append rows to BigQuery table {table_path}. Error: {e}') from e
+        if response.error.code:
+            raise ValueError(f'Could not append rows to BigQuery table {table_path}. Error: {response.error.message}')
+
+    @staticmethod
+    def _close_connection(stream):
+        # Closing an inactive (already closed or broken) connection raises
+        if stream['connection'].is_active:
+            stream['connection'].close()
+
+    def commit(self):
+        try:
+            for table_path, stream in self.streams.items():
+                for future in stream['futures']:
+                    self._check_response(table_path, future)
+                self._close_connection(stream)
+                self.write_client.finalize_write_stream(name=stream['name'])
+                response = self.write_client.batch_commit_write_streams(
+                    self.types.BatchCommitWriteStreamsRequest(parent=table_path, write_streams=[stream['name']])
+                )
+                if response.stream_errors:
+                    raise ValueError(f'Could not commit rows to BigQuery table {table_path}. Errors: {list(response.stream_errors)}')
+        finally:
+            self.close()
+
+    def close(self):
+        '''
+        Close connections of pending streams (rows not committed yet are discarded)
+        '''
+        for stream in self.streams.values():
+            self._close_connection(stream)
+        self.streams = {}
+
+
+class BigQueryLoadJobWriter:
+    '''
+    Stage formatted records in gzipped newline-delimited json files (one per table)
+    and load each file with a single BigQuery load job when `commit` is called.
+    Tables have a daily quota of load jobs: `is_ready` tells if files are large (`file_rows_max` records)
+    or old (`commit_interval` seconds) enough to be loaded.
+
+    If `gcs_prefix` is given (like `gs://bucket/folder`), files are uploaded there
+    and loaded from Cloud Storage. Else they are uploaded with the load job.
+    '''
+
+    def __init__(self, bigquery, dataset, gcs_prefix=None, file_rows_max=1000000, commit_interval=300):
+        self.bigquery = bigquery
+        self.dataset = dataset
+        self.gcs_prefix = gcs_prefix.rstrip('/') if gcs_prefix else None
+        self.file_rows_max = file_rows_max
+        self.commit_interval = commit_interval
+        self.temp_dir_obj = tempfile.TemporaryDirectory()
+        self.files = {}  # table --> (filename, file)
+        self.rows = {}  # table --> number of records in file
+        self.files_opened_at = None
+
+    def is_ready(self):
+        return (
+            not self.files or
+            max(self.rows.values()) >= self.file_rows_max or
+            time.monotonic() - self.files_opened_at >= self.commit_interval
+        )
+
+    def append(self, table, records):
+        if table not in self.files:
+            filename = os.path.join(self.temp_dir_obj.name, f'{table}.json.gz')
+            self.files[table] = (filename, gzip.open(filename, 'wt', encoding='utf-8', compresslevel=1))
+            self.rows[table] = 0
+            if self.files_opened_at is None:
+                self.files_opened_at = time.monotonic()
+        _, file = self.files[table]
+        self.rows[table] += len(records)
+        for record in records:
+            # `_airbyte_data` is written as json (and not as a json string) so that load job parses it
+            metadata = json.dumps({column: value for column, value in record.items() if column != '_airbyte_data'})
+            file.write(f'{metadata[:-1]}, "_airbyte_data": {record["_airbyte_data"]}}}\n')
+
+    def commit(self):
+        if not self.files:
+            return
+        import google.cloud.bigquery
+        job_config = google.cloud.bigquery.LoadJobConfig(
+            source_format=google.cloud.bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=google.cloud.bigquery.WriteDisposition.WRITE_APPEND,
+        )
+        jobs = []
+        blobs = []
+        for table, (filename, file) in self.files.items():
+            file.close()
+            destination = f'{self.dataset}.{table}'
+            if self.gcs_prefix:
+                import google.cloud.storage
+                uri = f'{self.gcs_prefix}/{table}/{uuid.uuid4()}.json.gz'
+                blob = google.cloud.storage.Blob.from_string(uri, client=google.cloud.storage.Client(project=self.bigquery.project))
+                blob.upload_from_filename(filename)
+                blobs.append(blob)
+                jobs.append(self.bigquery.load_table_from_uri(uri, destination, job_config=job_config))
+            else:
+                with open(filename, 'rb') as source_file:
+                    jobs.append(self.bigquery.load_table_from_file(source_file, destination, job_config=job_config))
+        for job in jobs:
+            job.result()
+        for blob in blobs:
+            blob.delete()
+        for filename, _ in self.files.values():
+            os.remove(filename)
+        self.files = {}
+        self.rows = {}
+        self.files_opened_at = None
+
+    def close(self):
+        for _, file in self.files.values():
+            file.close()
+        self.files = {}
+        self.rows = {}
+        self.files_opened_at = None
+        self.temp_dir_obj.cleanup()
+
+
+def get_bigquery_column_name(field):
+    column = re.sub(r'[^a-zA-Z0-9_]', '_', field)
+    return f'_{column}' if not column or column[0].isdigit() else column
+
+
+def get_bigquery_type(field_schema):
+    '''
+    Return the BigQuery type of a json schema field. Unknown types are kept as JSON
+    '''
+    types = field_schema.get('type', [])
+    types = [types] if isinstance(types, str) else types
+    types = [type for type in types if type != 'null']
+    type = types[0] if len(types) == 1 else None
+    if type == 'string':
+        if field_schema.get('format') == 'date-time':
+            return 'DATETIME' if field_schema.get('airbyte_type') == 'timestamp_without_timezone' else 'TIMESTAMP'
+        if field_schema.get('format') == 'date':
+            return 'DATE'
+        return 'STRING'
+    return {
+        'integer': 'INT64',
+        'number': 'INT64' if field_schema.get('airbyte_type') == 'integer' else 'FLOAT64',
+        'boolean': 'BOOL',
+    }.get(type, 'JSON')
+
+
+def get_bigquery_typed_columns(json_schema):
+    '''
+    Return (column, type, field) of top level fields of a stream json schema.
+    Fields with quotes or backslashes (which cannot be used in json paths) stay in `_airbyte_data` only
+    '''
+    columns = {}
+    for field, field_schema in (json_schema.get('properties') or {}).items():
+        column = get_bigquery_column_name(field)
+        if column.lower() in columns or re.search(r'[\'"\\]', field):
+            continue
+        columns[column.lower()] = (column, get_bigquery_type(field_schema or {}), field)
+    return list(columns.values())
+
+
+BIGQUERY_LEGACY_TYPES = {'INTEGER': 'INT64', 'FLOAT': 'FLOAT64', 'BOOLEAN': 'BOOL'}
+BIGQUERY_CLUSTERABLE_TYPES = ['STRING', 'INT64', 'BOOL', 'TIMESTAMP', 'DATE', 'DATETIME', 'NUMERIC']
+
+
+BIGQUERY_CLIENTS = {}
+BIGQUERY_CLIENTS_LOCK = threading.Lock()
+BIGQUERY_HTTP_POOL_SIZE = 64
+
+
+def get_bigquery_client(project):
+    '''
+    Return a BigQuery client for `project` shared by all destinations of the process,
+    with an http connection pool large enough for connections running concurrently
+    '''
+    with BIGQUERY_CLIENTS_LOCK:
+        if project not in BIGQUERY_CLIENTS:
+            import requests.adapters
+            import google.auth
+            import google.auth.transport.requests
+            import google.cloud.bigquery
+            credentials, _ = google.auth.default(scopes=google.cloud.bigquery.Client.SCOPE)
+            http = google.auth.transport.requests.AuthorizedSession(credentials)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=BIGQUERY_HTTP_POOL_SIZE, pool_maxsize=BIGQUERY_HTTP_POOL_SIZE)
+            http.mount('https://', adapter)
+            BIGQUERY_CLIENTS[project] = google.cloud.bigquery.Client(project=project, _http=http)
+        return BIGQUERY_CLIENTS[project]
+
+
 class BigQueryDestination(BaseDestination):
 
     yaml_definition_example = (
         BaseDestination.yaml_definition_example + '\n' +
-        'dataset: "" # REQUIRED | string | Destination dataset. Must be fully qualified with project like `PROJECT.DATASET`'
+        'dataset: "" # REQUIRED | string | Destination dataset. Must be fully qualified with project like `PROJECT.DATASET`' + '\n' +
+        'write_api: "insert_all" # OPTIONAL | string | BigQuery API used to write records. One of `insert_all` (legacy streaming API), `storage` (Storage Write API: cheaper and faster, records of a slice are committed atomically at each state) or `load_job` (records are staged in local files and loaded with one load job per table at a state once large or old enough, see below: best for large full-refresh extracts)' + '\n' +
+        'staging_gcs_prefix: "" # OPTIONAL | string | Only used with `load_job` write_api. Cloud Storage prefix such as `gs://BUCKET/FOLDER` where staging files are uploaded before being loaded. If empty, files are directly uploaded with load jobs' + '\n' +
+        'file_rows_max: 1000000 # OPTIONAL | integer | Only used with `load_job` write_api. Staging files are loaded at the next state once one of them has this number of records' + '\n' +
+        'commit_interval: 300 # OPTIONAL | number | Only used with `load_job` write_api. Staging files are loaded at the next state once opened for this number of seconds, to stay under the daily quota of load jobs per table (states are written once loaded: a failed run restarts from there)' + '\n' +
+        'typed_tables: false # OPTIONAL | boolean | If true, raw records are also inserted at each state in one final table per stream (named as the stream) with typed columns derived from the stream json schema and clustered on primary key and cursor field. Final tables are always used for streams with `append_dedup` destination sync mode'
     )
 
-    def __init__(self, dataset='', **kwargs):
+    # State key (see `get_state_key`) of `_airbyte_states` rows, computed from the state for rows written before the `state_key` column
+    state_key_expression = (
+        "coalesce(state_key, case json_value(_airbyte_data, '$.type') "
+        "when 'STREAM' then concat('STREAM:', json_value(_airbyte_data, '$.stream.stream_descriptor.name')) "
+        "when 'GLOBAL' then 'GLOBAL' else 'LEGACY' end)"
+    )
+
+    final_metadata_columns = [
+        ('_airbyte_raw_id', 'STRING'),
+        ('_airbyte_extracted_at', 'TIMESTAMP'),
+        ('_airbyte_loaded_at', 'TIMESTAMP'),
+    ]
+
+    def __init__(self, dataset='', write_api='insert_all', staging_gcs_prefix='', typed_tables=False, file_rows_max=1000000, commit_interval=300, **kwargs):
         super().__init__(**kwargs)
-        import google.cloud.bigquery
         assert dataset, 'dataset argument must be defined'
         assert len(dataset.split('.')) == 2, '`BigQueryDestination.dataset` must be like `project.dataset`'
+        assert write_api in ['insert_all', 'storage', 'load_job'], '`BigQueryDestination.write_api` must be one of `insert_all`, `storage` or `load_job`'
         self.dataset = dataset.replace('`', '').strip()
         self.project, _ = self.dataset.split('.')
-        self.bigquery = google.cloud.bigquery.Client(project=self.project)
+        self.bigquery = get_bigquery_client(self.project)
+        self.write_api = write_api
+        self._storage_writer = None
+        self.load_job_writer = BigQueryLoadJobWriter(
+            self.bigquery, self.dataset, staging_gcs_prefix, file_rows_max=file_rows_max, commit_interval=commit_interval
+        ) if write_api == 'load_job' else None
         self.created_tables = []
+        self.latest_states = {}  # state key --> latest formatted state record written during the run
+        self.typed_tables = typed_tables
+
+    def close(self):
+        if self.load_job_writer is not None:
+            self.load_job_writer.close()
+        if self._storage_writer is not None:
+            self._storage_writer.close()
+
+    @property
+    def storage_writer(self):
+        if self._storage_writer is None:
+            import google.cloud.bigquery_storage_v1
+            write_client = google.cloud.bigquery_storage_v1.BigQueryWriteClient()
+            self._storage_writer = BigQueryStorageWriter(write_client, self.destination_columns)
+        return self._storage_writer
 
     def get_state(self):
+        '''
+        Read latest states from the small `_airbyte_latest_states` table, merged with the states of the history
+        table written after the latest state of their key (in case a run stopped or failed to merge its states).
+        Fallback to the whole history table if `_airbyte_latest_states` does not exist yet.
+        '''
+        import google.api_core.exceptions
+        import google.cloud.bigquery
+        try:
+            latest_states = list(self.bigquery.query(
+                f'select state_key, _airbyte_data, _airbyte_loaded_at from `{self.dataset}._airbyte_latest_states`'
+            ).result())
+        except google.api_core.exceptions.NotFound:
+            latest_states = []
+        if not latest_states:
+            return self._get_state_from_history()
+        self._create_table_if_needed('_airbyte_states')
+        # `_airbyte_latest_states` is filled from the whole history when created. Then, history only has newer states
+        # for runs whose merge failed: their states are merged again by the next run (see below) so that only the
+        # last run (lasting less than a day) can have states to recover. The constant timestamp filter
+        # lets only the last partitions of history be scanned, whatever the age of states of inactive streams.
+        job_config = google.cloud.bigquery.QueryJobConfig(query_parameters=[
+            google.cloud.bigquery.ScalarQueryParameter(
+                'min_loaded_at', 'TIMESTAMP', max(row._airbyte_loaded_at for row in latest_states) - datetime.timedelta(days=1)
+            ),
+        ])
+        recent_states = list(self.bigquery.query(f'''
+            select history.state_key, history._airbyte_data, history._airbyte_loaded_at
+            from (
+                select {self.state_key_expression} as state_key, _airbyte_data, _airbyte_loaded_at
+                from `{self.dataset}._airbyte_states`
+                where _airbyte_loaded_at >= @min_loaded_at
+            ) history
+            left join `{self.dataset}._airbyte_latest_states` latest_states
+            on history.state_key = latest_states.state_key
+            where latest_states.state_key is null or history._airbyte_loaded_at > latest_states._airbyte_loaded_at
+            qualify row_number() over (partition by history.state_key order by history._airbyte_loaded_at desc) = 1
+        ''', job_config=job_config).result())
+        for row in recent_states:
+            # Merged again at the end of the run unless the run writes a newer state for the key
+            self.latest_states[row.state_key] = {
+                '_airbyte_data': json.dumps(row._airbyte_data),
+                '_airbyte_loaded_at': row._airbyte_loaded_at.isoformat(),
+            }
+        return get_latest_state(
+            (row._airbyte_data, row._airbyte_loaded_at)
+            for row in latest_states + recent_states
+        )
+
+    def _get_state_from_history(self):
         import google.api_core.exceptions
         try:
             rows = self.bigquery.query(f'''
@@ -190,13 +735,237 @@ class BigQueryDestination(BaseDestination):
             return {}
         return states[0].state
 
+    def load(self, messages, configured_catalog=None, metrics=None):
+        self.final_tables = {}  # stream --> (final table, columns types, fields of typed columns) of final tables prepared during the run
+        self.undeduplicated_streams = set()  # `append_dedup` streams whose primary key cannot be used to merge records
+        self.slice_streams = set()  # streams with records written during the slices not committed yet
+        self.commit_slice_started_at = None  # start of the first slice not committed yet
+        self.pending_states = []  # states waiting for the records of their slice to be committed
+        try:
+            super().load(messages, configured_catalog=configured_catalog, metrics=metrics)
+            if self.commit_slice_started_at is not None:
+                with self.metrics.timer('commit_seconds'):
+                    self._commit_slices()
+        finally:
+            self._merge_latest_states()
+
+    def _get_final_table(self, configured_stream):
+        '''
+        Return the final table of `configured_stream` (with one typed column per top level field of its
+        json schema), its columns types and the field of each typed column. The table is created if needed and new fields of json schema
+        are added as new columns (existing columns keep their type).
+        '''
+        stream = configured_stream['stream']
+        if stream['name'] in self.final_tables:
+            return self.final_tables[stream['name']]
+        final_table = f'{self.dataset}.{get_bigquery_column_name(stream["name"])}'
+        columns = get_bigquery_typed_columns(stream.get('json_schema') or {})
+        types = dict(
+            [(column, type) for column, type in self.final_metadata_columns] +
+            [(column, type) for column, type, _ in columns if column not in dict(self.final_metadata_columns)]
+        )
+        cluster_columns = [
+            get_bigquery_column_name(path[0])
+            for path in (stream.get('source_defined_primary_key') or []) + [configured_stream.get('cursor_field') or []]
+            if path
+        ]
+        cluster_columns = [column for column in dict.fromkeys(cluster_columns) if types.get(column) in BIGQUERY_CLUSTERABLE_TYPES][:4]
+        columns_definitions = ', '.join(f'`{column}` {type}' for column, type in types.items())
+        self.bigquery.query(f'''
+            create table if not exists `{final_table}` ({columns_definitions})
+            partition by date(_airbyte_loaded_at)
+            {'cluster by ' + ', '.join(f'`{column}`' for column in cluster_columns) if cluster_columns else ''}
+            options(description="{stream["name"]} records ingested by airbyte_serverless with typed columns")
+        ''').result()
+        existing_types = {
+            field.name: BIGQUERY_LEGACY_TYPES.get(field.field_type, field.field_type)
+            for field in self.bigquery.get_table(final_table).schema
+        }
+        new_columns = [(column, type) for column, type in types.items() if column not in existing_types]
+        if new_columns:
+            self.bigquery.query(
+                f'alter table `{final_table}` ' +
+                ', '.join(f'add column if not exists `{column}` {type}' for column, type in new_columns)
+            ).result()
+            existing_types.update(new_columns)
+        types = {column: existing_types[column] for column in types}
+        self.final_tables[stream['name']] = (final_table, types, {column: field for column, _, field in columns})
+        return self.final_tables[stream['name']]
+
+    def _update_final_table(self, configured_stream):
+        '''
+        Insert records of the slices not committed yet of `configured_stream` into its final table.
+        With `append_dedup` destination sync mode, they are merged instead on primary key,
+        keeping only the latest version of each record (by cursor field then extract time).
+        Only these slices are read from raw table so that cost grows with slice size and not table size.
+        '''
+        import google.cloud.bigquery
+        stream = configured_stream['stream']
+        final_table, types, fields = self._get_final_table(configured_stream)
+
+        def select_expression(column):
+            if column in dict(self.final_metadata_columns):
+                return f'`{column}`'
+            path = f'$."{fields[column]}"'
+            if types[column] == 'JSON':
+                return f"json_query(_airbyte_data, '{path}') as `{column}`"
+            if types[column] == 'STRING':
+                return f"json_value(_airbyte_data, '{path}') as `{column}`"
+            return f"safe_cast(json_value(_airbyte_data, '{path}') as {types[column]}) as `{column}`"
+
+        columns = [column for column in types if column in dict(self.final_metadata_columns) or column in fields]
+        slice_records = f'''
+            select {', '.join(select_expression(column) for column in columns)}
+            from `{self.dataset}._airbyte_raw_{stream["name"]}`
+            where _airbyte_loaded_at >= @slice_started_at  -- prunes partitions
+              and _airbyte_slice_started_at >= @slice_started_at
+              and _airbyte_job_started_at = @job_started_at
+        '''
+        job_config = google.cloud.bigquery.QueryJobConfig(query_parameters=[
+            google.cloud.bigquery.ScalarQueryParameter('slice_started_at', 'TIMESTAMP', datetime.datetime.fromisoformat(self.commit_slice_started_at)),
+            google.cloud.bigquery.ScalarQueryParameter('job_started_at', 'TIMESTAMP', datetime.datetime.fromisoformat(self.job_started_at)),
+        ])
+        def get_comparable_column(path):
+            # Only top level fields with typed columns that can be compared and partitioned on (not json)
+            column = get_bigquery_column_name(path[0]) if len(path) == 1 else None
+            return column if column in fields and types[column] in BIGQUERY_CLUSTERABLE_TYPES else None
+
+        key_paths = stream.get('source_defined_primary_key') or []
+        primary_key = [get_comparable_column(path) for path in key_paths]
+        columns_list = ', '.join(f'`{column}`' for column in columns)
+        if configured_stream.get('destination_sync_mode') != 'append_dedup' or not key_paths or None in primary_key:
+            if configured_stream.get('destination_sync_mode') == 'append_dedup' and stream['name'] not in self.undeduplicated_streams:
+                # Deduplicating on a part of the primary key would merge distinct records
+                print(
+                    f'WARNING: records of stream {stream["name"]} are not deduplicated in final table: '
+                    f'its primary key {key_paths} must only have top level fields of comparable types (not json)'
+                )
+                self.undeduplicated_streams.add(stream['name'])
+            self.bigquery.query(f'insert into `{final_table}` ({columns_list}) {slice_records}', job_config=job_config).result()
+            return
+        cursor = get_comparable_column(configured_stream.get('cursor_field') or [])
+        order_by = ([f'`{cursor}` desc'] if cursor else []) + ['_airbyte_extracted_at desc', '_airbyte_loaded_at desc']
+        # Records of a run never replace later versions of final table (from a rerun of an older slice or a concurrent run)
+        version = f'`{cursor}`' if cursor else '_airbyte_extracted_at'
+        self.bigquery.query(f'''
+            merge `{final_table}` final
+            using (
+                select * from ({slice_records})
+                qualify row_number() over (partition by {', '.join(f'`{column}`' for column in primary_key)} order by {', '.join(order_by)}) = 1
+            ) new_records
+            on {' and '.join(f'final.`{column}` is not distinct from new_records.`{column}`' for column in primary_key)}
+            when matched and (new_records.{version} >= final.{version} or final.{version} is null) then
+                update set {', '.join(f'`{column}` = new_records.`{column}`' for column in columns)}
+            when not matched then
+                insert ({columns_list}) values ({', '.join(f'new_records.`{column}`' for column in columns)})
+        ''', job_config=job_config).result()
+
+    def _merge_latest_states(self):
+        '''
+        Upsert states written during the run in `_airbyte_latest_states` (one row per state key).
+        The table is filled with the latest states of the whole history when created.
+        A failure is not fatal since `get_state` also reads, for each key, the states of history written after its latest state.
+        '''
+        if not self.latest_states:
+            return
+        import google.cloud.bigquery
+        rows = [
+            {'state_key': key, 'state': json.loads(record['_airbyte_data']), 'loaded_at': record['_airbyte_loaded_at']}
+            for key, record in self.latest_states.items()
+        ]
+        job_config = google.cloud.bigquery.QueryJobConfig(query_parameters=[
+            google.cloud.bigquery.ScalarQueryParameter('rows', 'STRING', json.dumps(rows)),
+        ])
+        try:
+            self.bigquery.query(f'''
+                if not exists (
+                    select 1 from `{self.dataset}.INFORMATION_SCHEMA.TABLES` where table_name = '_airbyte_latest_states'
+                ) then
+                    create table `{self.dataset}._airbyte_latest_states` (
+                        state_key string options(description="`STREAM:<stream name>`, `GLOBAL` or `LEGACY`"),
+                        _airbyte_data json options(description="Latest state of the key as json"),
+                        _airbyte_loaded_at timestamp options(description="State ingestion timestamp")
+                    )
+                    options(
+                        description="Latest states ingested by airbyte_serverless (one per state key)"
+                    )
+                    as
+                    select state_key, _airbyte_data, _airbyte_loaded_at
+                    from (
+                        select {self.state_key_expression} as state_key, _airbyte_data, _airbyte_loaded_at
+                        from `{self.dataset}._airbyte_states`
+                    )
+                    qualify row_number() over (partition by state_key order by _airbyte_loaded_at desc) = 1;
+                end if;
+
+                merge `{self.dataset}._airbyte_latest_states` latest_states
+                using (
+                    select
+                        json_value(row, '$.state_key') as state_key,
+                        parse_json(json_query(row, '$.state')) as _airbyte_data,
+                        timestamp(json_value(row, '$.loaded_at')) as _airbyte_loaded_at,
+                    from unnest(json_query_array(@rows)) as row
+                ) new_states
+                on latest_states.state_key = new_states.state_key
+                when matched and new_states._airbyte_loaded_at >= latest_states._airbyte_loaded_at then
+                    update set _airbyte_data = new_states._airbyte_data, _airbyte_loaded_at = new_states._airbyte_loaded_at
+                when not matched then
+                    insert (state_key, _airbyte_data, _airbyte_loaded_at)
+                    values (new_states.state_key, new_states._airbyte_data, new_states._airbyte_loaded_at)
+            ''', job_config=job_config).result()
+            self.latest_states = {}
+        except Exception as e:
+            print(f'Could not merge states in {self.dataset}._airbyte_latest_states: {e}')
+
     def _write(self, record_type, records):
         table = record_type
         self._create_table_if_needed(table)
+        if table.startswith('_airbyte_raw_'):
+            self.slice_streams.add(table[len('_airbyte_raw_'):])
+        if table == '_airbyte_states':
+            if self.commit_slice_started_at is not None:
+                # Records of the states are not loaded yet
+                self.pending_states.extend(records)
+                return
+            for record in records:
+                record['state_key'] = get_state_key(json.loads(record['_airbyte_data']))
+                self.latest_states[record['state_key']] = record
+        if self.write_api == 'storage' and table.startswith('_airbyte_raw'):
+            dataset_project, dataset = self.dataset.split('.')
+            self.storage_writer.append(f'projects/{dataset_project}/datasets/{dataset}/tables/{table}', records)
+            return
+        if self.write_api == 'load_job' and table.startswith('_airbyte_raw'):
+            self.load_job_writer.append(table, records)
+            return
         errors = self.bigquery.insert_rows_json(f'{self.dataset}.{table}', records)
         if errors:
             raise ValueError(f'Could not insert rows to BigQuery table {table}. Errors: {errors}')
 
+    def _commit(self):
+        if self.commit_slice_started_at is None:
+            self.commit_slice_started_at = self.slice_started_at
+        # Staging files are loaded at a later state (or at the end of the run) if they are small and recent
+        if self.load_job_writer is not None and not self.load_job_writer.is_ready():
+            return
+        self._commit_slices()
+
+    def _commit_slices(self):
+        if self._storage_writer is not None:
+            self._storage_writer.commit()
+        if self.load_job_writer is not None:
+            self.load_job_writer.commit()
+        # Records of the slices are now all readable in raw tables: they can be put in final tables
+        for configured_stream in self.configured_catalog['streams']:
+            if configured_stream['stream']['name'] not in self.slice_streams:
+                continue
+            if self.typed_tables or configured_stream.get('destination_sync_mode') == 'append_dedup':
+                self._update_final_table(configured_stream)
+        self.slice_streams = set()
+        self.commit_slice_started_at = None
+        if self.pending_states:
+            states, self.pending_states = self.pending_states, []
+            self._write('_airbyte_states', states)
+
     def _create_table_if_needed(self, table):
         if table in self.created_tables:
             return
@@ -204,6 +973,24 @@ class BigQueryDestination(BaseDestination):
             f'{column} {type} options(description="{description}")'
             for column, type, description in self.destination_columns
         ])
+        if table == '_airbyte_states':
+            # Clustered on state key so that history of a stream is cheap to audit
+            self.bigquery.query(f'''
+                create table if not exists `{self.dataset}.{table}` (
+                    {columns_definitions},
+                    state_key string options(description="`STREAM:<stream name>`, `GLOBAL` or `LEGACY`")
+                )
+                partition by date(_airbyte_loaded_at)
+                cluster by state_key
+                options(
+                    description="{table} records ingested by airbyte_serverless"
+                );
+
+                -- Tables created by previous versions
+                alter table `{self.dataset}.{table}` add column if not exists state_key string options(description="`STREAM:<stream name>`, `GLOBAL` or `LEGACY`");
+            ''').result()
+            self.created_tables.append(table)
+            return
         self.bigquery.query(f'''
             create table if not exists `{self.dataset}.{table}` (
                 {columns_definitions}
@@ -216,9 +1003,234 @@ class BigQueryDestination(BaseDestination):
         self.created_tables.append(table)
 
 
+class ParquetDestination(BaseDestination):
+    '''
+    Write records in parquet files partitioned by stream and loaded date:
+    `{folder}/_airbyte_raw_{stream}/airbyte_loaded_date={date}/{uuid}.parquet`.
+
+    Files are written with a hidden temporary name and renamed once closed (and then readable), at a state
+    once one of them has `file_rows_max` rows or once they were opened `commit_interval` seconds ago,
+    and at the end of the run. Files of a failed run are deleted. States are only appended
+    as json lines to `{folder}/_airbyte_states.jsonl` when the files of their records are closed
+    (so a failed run resumes from the last closed files). Logs are appended to `{folder}/_airbyte_logs.jsonl`.
+    '''
+
+    yaml_definition_example = (
+        BaseDestination.yaml_definition_example + '\n' +
+        'folder: "" # REQUIRED | string | Local folder where parquet files are written' + '\n' +
+        'compression: "snappy" # OPTIONAL | string | Parquet compression codec. One of `snappy`, `zstd`, `gzip`, `lz4`, `brotli` or `none`' + '\n' +
+        'row_group_size: 100000 # OPTIONAL | integer | Number of records of parquet row groups' + '\n' +
+        'file_rows_max: 1000000 # OPTIONAL | integer | Parquet files are closed at the next state once one of them has this number of records' + '\n' +
+        'commit_interval: 300 # OPTIONAL | number | Parquet files are closed at the next state once opened for this number of seconds (states are committed when files are closed: a failed run restarts from there)'
+    )
+
+    columnar = True
+
+    def __init__(self, folder='', compression='snappy', row_group_size=100000, file_rows_max=1000000, commit_interval=300, **kwargs):
+        super().__init__(**kwargs)
+        import pyarrow
+        import pyarrow.parquet
+        assert folder, 'folder argument must be defined'
+        self.pyarrow = pyarrow
+        self.folder = folder
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.file_rows_max = file_rows_max
+        self.commit_interval = commit_interval
+        self.schema = pyarrow.schema([
+            (column, pyarrow.timestamp('us') if type == 'timestamp' else pyarrow.string())
+            for column, type, _ in self.destination_columns
+        ])
+        self.writers = {}  # partition folder --> [parquet writer, record batches waiting to be written, rows count, file name]
+        self.files_opened_at = None
+        self.pending_states = []  # states waiting for the files of their records to be closed
+        os.makedirs(self.folder, exist_ok=True)
+
+    def get_state(self):
+        filename = os.path.join(self.folder, '_airbyte_states.jsonl')
+        if not os.path.isfile(filename):
+            return {}
+        with open(filename, encoding='utf-8') as file:
+            rows = [json.loads(line) for line in file if line.strip()]
+        return get_latest_state(
+            (json.loads(row['_airbyte_data']), row['_airbyte_loaded_at'])
+            for row in rows
+        )
+
+    def _to_record_batch(self, columns):
+        pyarrow = self.pyarrow
+        return pyarrow.RecordBatch.from_arrays(
+            [
+                pyarrow.array(columns[field.name], type=pyarrow.string()).cast(field.type)
+                for field in self.schema
+            ],
+            schema=self.schema,
+        )
+
+    def close(self):
+        '''
+        Delete files still open (records of a failed run, whose states were not written)
+        '''
+        for writer, _, _, filename in self.writers.values():
+            writer.close()
+            os.remove(self._get_temporary_filename(filename))
+        self.writers = {}
+        self.files_opened_at = None
+        self.pending_states = []
+
+    def load(self, messages, configured_catalog=None, metrics=None):
+        super().load(messages, configured_catalog=configured_catalog, metrics=metrics)
+        self._close_files()
+
+    @staticmethod
+    def _get_temporary_filename(filename):
+        # Hidden files are skipped by parquet readers (and do not match `*.parquet`)
+        folder, name = os.path.split(filename)
+        return os.path.join(folder, f'.{name}.tmp')
+
+    def _append_jsonl(self, record_type, records):
+        with open(os.path.join(self.folder, f'{record_type}.jsonl'), 'a', encoding='utf-8') as file:
+            file.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+            file.flush()
+            os.fsync(file.fileno())
+
+    def _write(self, record_type, columns):
+        if record_type == '_airbyte_states' and self.writers:
+            # Records of the state are not readable before their files are closed
+            self.pending_states.extend(columns_to_rows(columns))
+            return
+        if not record_type.startswith('_airbyte_raw'):
+            self._append_jsonl(record_type, columns_to_rows(columns))
+            return
+        loaded_date = columns['_airbyte_loaded_at'][0][:10]
+        partition = os.path.join(self.folder, record_type, f'airbyte_loaded_date={loaded_date}')
+        if partition not in self.writers:
+            import pyarrow.parquet
+            os.makedirs(partition, exist_ok=True)
+            filename = os.path.join(partition, f'{uuid.uuid4()}.parquet')
+            writer = pyarrow.parquet.ParquetWriter(
+                self._get_temporary_filename(filename),
+                self.schema,
+                compression=self.compression,
+            )
+            self.writers[partition] = [writer, [], 0, filename]
+            if self.files_opened_at is None:
+                self.files_opened_at = time.monotonic()
+        batches = self.writers[partition][1]
+        batches.append(self._to_record_batch(columns))
+        self.writers[partition][2] += len(columns['_airbyte_raw_id'])
+        if sum(batch.num_rows for batch in batches) >= self.row_group_size:
+            self._write_row_group(partition)
+
+    def _write_row_group(self, partition):
+        writer, batches, _, _ = self.writers[partition]
+        if batches:
+            writer.write_table(self.pyarrow.Table.from_batches(batches), row_group_size=self.row_group_size)
+            batches.clear()
+
+    def _commit(self):
+        # Closing files at each state would give small files and row groups
+        if (
+            not self.writers or
+            max(rows for _, _, rows, _ in self.writers.values()) >= self.file_rows_max or
+            time.monotonic() - self.files_opened_at >= self.commit_interval
+        ):
+            self._close_files()
+
+    def _close_files(self):
+        for partition in list(self.writers):
+            self._write_row_group(partition)
+            writer, _, _, filename = self.writers.pop(partition)
+            writer.close()
+            os.replace(self._get_temporary_filename(filename), filename)
+        self.files_opened_at = None
+        # Records of pending states are now all readable
+        if self.pending_states:
+            self._append_jsonl('_airbyte_states', self.pending_states)
+            self.pending_states = []
+
+
+class DuckDBDestination(BaseDestination):
+    '''
+    Write records in a local DuckDB database, in `_airbyte_raw_{stream}`,
+    `_airbyte_states` and `_airbyte_logs` tables with the same columns as BigQuery.
+
+    Each buffer is registered as an Arrow table and appended with one `insert ... select`
+    (with one `executemany` insert if pyarrow is not installed).
+    '''
+
+    yaml_definition_example = (
+        BaseDestination.yaml_definition_example + '\n' +
+        'database: "airbyte.duckdb" # REQUIRED | string | Path of the DuckDB database file (`:memory:` for an in-memory database)'
+    )
+
+    column_types = {
+        'string': 'varchar',
+        'timestamp': 'timestamp',
+        'json': 'json',
+    }
+
+    columnar = True
+
+    def __init__(self, database='', **kwargs):
+        super().__init__(**kwargs)
+        import duckdb
+        assert database, 'database argument must be defined'
+        self.database = database
+        self.duckdb = duckdb.connect(database)
+        self.created_tables = []
+        try:
+            import pyarrow
+            self.pyarrow = pyarrow
+        except ImportError:
+            self.pyarrow = None
+
+    def close(self):
+        self.duckdb.close()
+
+    def get_state(self):
+        tables = [row[0] for row in self.duckdb.execute('select table_name from information_schema.tables').fetchall()]
+        if '_airbyte_states' not in tables:
+            return {}
+        rows = self.duckdb.execute('select _airbyte_data, _airbyte_loaded_at from _airbyte_states').fetchall()
+        return get_latest_state((json.loads(state), loaded_at) for state, loaded_at in rows)
+
+    def _write(self, record_type, columns):
+        table = record_type
+        self._create_table_if_needed(table)
+        names = [column for column, _, _ in self.destination_columns]
+        if self.pyarrow is None:
+            rows = list(zip(*[columns[column] for column in names]))
+            self.duckdb.executemany(f'insert into "{table}" values ({", ".join("?" for _ in names)})', rows)
+            return
+        # Columns are scanned by duckdb from the arrow table without conversion to python objects
+        batch = self.pyarrow.table({column: self.pyarrow.array(columns[column], type=self.pyarrow.string()) for column in names})
+        self.duckdb.register('_airbyte_batch', batch)
+        try:
+            self.duckdb.execute(
+                f'insert into "{table}" select ' + ', '.join(
+                    f'{column}::{self.column_types[type]}' for column, type, _ in self.destination_columns
+                ) + ' from _airbyte_batch'
+            )
+        finally:
+            self.duckdb.unregister('_airbyte_batch')
+
+    def _create_table_if_needed(self, table):
+        if table in self.created_tables:
+            return
+        columns_definitions = ', '.join([
+            f'{column} {self.column_types[type]}'
+            for column, type, _ in self.destination_columns
+        ])
+        self.duckdb.execute(f'create table if not exists "{table}" ({columns_definitions})')
+        self.created_tables.append(table)
+
+
 DESTINATION_CLASS_MAP = {
     'print': PrintDestination,
     'bigquery': BigQueryDestination,
+    'parquet': ParquetDestination,
+    'duckdb': DuckDBDestination,
 }
 
 
@@ -239,6 +1251,10 @@ class Destination:
             '  ' + self.destination_class.yaml_definition_example.replace('\n', '\n  '),
         ])
 
+    def close(self):
+        if self._destination is not None:
+            self._destination.close()
+
     def __getattr__(self, name):
         if self._destination is None:
             self._destination = self.destination_class(**self.config)
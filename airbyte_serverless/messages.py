@@ -0,0 +1,265 @@
+import os
+import re
+import json
+import time
+import queue
+import threading
+
+try:
+    import orjson
+    json_loads, JSONDecodeError = orjson.loads, orjson.JSONDecodeError
+except ImportError:
+    try:
+        import msgspec
+        json_loads, JSONDecodeError = msgspec.json.decode, msgspec.DecodeError
+    except ImportError:
+        json_loads, JSONDecodeError = json.loads, ValueError
+
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Message yielded when the source has not emitted anything for a while, so that the destination can flush old buffers
+TICK_MESSAGE = {'type': 'TICK'}
+
+RAW_RECORD_PREFIX = re.compile(
+    rb'\{\s*"type"\s*:\s*"RECORD"\s*,\s*"record"\s*:\s*\{\s*'
+    rb'"stream"\s*:\s*"((?:[^"\\]|\\.)*)"\s*,\s*"data"\s*:\s*(?=\{)'
+)
+RAW_RECORD_SUFFIX = re.compile(rb'\}\s*,\s*"emitted_at"\s*:\s*(\d+)\s*\}\s*\}$')
+RAW_RECORD_SUFFIX_MAX_LENGTH = 64
+
+
+class RawJson(bytes):
+    '''
+    A json document kept serialized, as it was emitted by the connector
+    '''
+
+
+def to_raw_json(data):
+    if isinstance(data, RawJson):
+        return data
+    return RawJson(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+
+def iter_lines(file, chunk_size=READ_CHUNK_SIZE, metrics=None):
+    '''
+    Yield lines (as bytes, without trailing newline) of binary `file`.
+
+    Reads are done by large chunks directly on the file descriptor
+    which is much faster than `readline` for pipes with a high throughput.
+    If `metrics` is given, time blocked waiting for data and read bytes are counted.
+    '''
+    fd = file.fileno()
+    remainder = b''
+    while True:
+        start = time.perf_counter()
+        chunk = os.read(fd, chunk_size)
+        if metrics is not None:
+            metrics.increment('source_read_blocked_seconds', time.perf_counter() - start)
+            metrics.increment('source_bytes', len(chunk))
+        if not chunk:
+            break
+        lines = chunk.split(b'\n')
+        if remainder:
+            lines[0] = remainder + lines[0]
+        remainder = lines.pop()
+        yield from lines
+    if remainder:
+        yield remainder
+
+
+def print_lines(file):
+    for line in iter_lines(file):
+        line = line.decode('utf-8', errors='replace').rstrip()
+        if line:
+            print(line)
+
+
+def start_draining(file):
+    '''
+    Print lines of `file` from a background thread, so that
+    the process writing to it never blocks on a full pipe.
+    '''
+    thread = threading.Thread(target=print_lines, args=(file,), daemon=True)
+    thread.start()
+    return thread
+
+
+def parse_raw_record(line):
+    '''
+    Return a RECORD message whose `data` is the `RawJson` slice of `line`
+    or None if `line` is not a RECORD with the usual field order
+    (`stream`, `data`, `emitted_at`). Only the envelope is parsed.
+    '''
+    prefix = RAW_RECORD_PREFIX.match(line)
+    if prefix is None:
+        return None
+    data_start = prefix.end()
+    suffix = RAW_RECORD_SUFFIX.search(line, max(data_start, len(line) - RAW_RECORD_SUFFIX_MAX_LENGTH))
+    if suffix is None:
+        return None
+    stream = prefix.group(1)
+    stream = json_loads(b'"' + stream + b'"') if b'\\' in stream else stream.decode('utf-8')
+    return {
+        'type': 'RECORD',
+        'record': {
+            'stream': stream,
+            'data': RawJson(memoryview(line)[data_start:suffix.start() + 1]),
+            'emitted_at': int(suffix.group(1)),
+        },
+    }
+
+
+def read_messages(file, raw=False, metrics=None):
+    '''
+    Yield Airbyte messages (as dicts) parsed from binary `file`.
+
+    If `raw` is True, the `data` of RECORD messages is not parsed
+    but kept as `RawJson` bytes.
+    Lines which are not json are printed and skipped.
+    If `metrics` is given, parse time and messages count are recorded.
+    '''
+    parse_seconds = 0
+    messages_count = 0
+    perf_counter = time.perf_counter
+    try:
+        for line in iter_lines(file, metrics=metrics):
+            start = perf_counter()
+            message = parse_message(line, raw)
+            parse_seconds += perf_counter() - start
+            if message is None:
+                continue
+            messages_count += 1
+            if metrics is not None and messages_count % 10000 == 0:
+                metrics.increment('source_parse_seconds', parse_seconds)
+                metrics.increment('source_messages', 10000)
+                parse_seconds = 0
+            yield message
+    finally:
+        if metrics is not None:
+            metrics.increment('source_parse_seconds', parse_seconds)
+            metrics.increment('source_messages', messages_count % 10000)
+
+
+def parse_message(line, raw=False):
+    '''
+    Return the Airbyte message of `line` (see `read_messages`) or None if it is not json
+    '''
+    line = line.strip()
+    if raw:
+        message = parse_raw_record(line)
+        if message is not None:
+            return message
+    if not line.startswith(b'{'):
+        if line:
+            print('NOT JSON:', line.decode('utf-8', errors='replace'))
+        return None
+    try:
+        return json_loads(line)
+    except JSONDecodeError:
+        print('NOT JSON:', line.decode('utf-8', errors='replace'))
+        return None
+
+
+def merge_in_background(iterables, batch_size=1000, queue_size=10, metrics=None, tick=None, tick_interval=1):
+    '''
+    Consume each of `iterables` in its own background thread and yield their items
+    as they come. Items of a same iterable keep their order.
+
+    Items go through a queue of at most `queue_size` batches of `batch_size` items
+    so that producers block when the consumer lags behind (backpressure).
+    Batches are handed over as soon as the consumer is idle, so that items are never stuck.
+    Exceptions raised by a producer are raised back by the consumer.
+    If `tick` is given, it is yielded each time no item came for `tick_interval` seconds
+    (after items a blocked producer had not handed over yet).
+    If `metrics` is given, time spent by the consumer waiting for items is counted.
+    '''
+    batches = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+    end = object()
+    producers = [(threading.Lock(), []) for _ in iterables]  # (lock, items not handed over yet) of each producer
+
+    def put(batch):
+        while not stopped.is_set():
+            try:
+                batches.put(batch, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def take(batch):
+        # Only the producer appends to its batch: items appended meanwhile are kept
+        items = batch[:]
+        del batch[:len(items)]
+        return items
+
+    def produce(iterable, lock, batch):
+        try:
+            for item in iterable:
+                batch.append(item)
+                if len(batch) >= batch_size or batches.empty():
+                    with lock:
+                        items = take(batch)
+                        if items and not put(items):
+                            return
+            with lock:
+                put(take(batch))
+                put(end)
+        except BaseException as e:
+            put(e)
+        finally:
+            close = getattr(iterable, 'close', None)
+            if close:
+                close()
+
+    def take_pending_items():
+        # Producer locks are only tried: a producer holding its lock is handing over its batch
+        items = []
+        for lock, batch in producers:
+            if lock.acquire(blocking=False):
+                try:
+                    # Items queued by the producer must be yielded before its pending items
+                    if batches.empty():
+                        items.extend(take(batch))
+                finally:
+                    lock.release()
+        return items
+
+    threads = [
+        threading.Thread(target=produce, args=(iterable, *producer), daemon=True)
+        for iterable, producer in zip(iterables, producers)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            start = time.perf_counter()
+            try:
+                batch = batches.get(timeout=tick_interval if tick is not None else None)
+            except queue.Empty:
+                batch = take_pending_items() + [tick]
+            if metrics is not None:
+                metrics.increment('consumer_blocked_seconds', time.perf_counter() - start)
+            if batch is end:
+                running -= 1
+                continue
+            if isinstance(batch, BaseException):
+                raise batch
+            yield from batch
+    finally:
+        stopped.set()
+        # Producers may be waiting for their next item: don't wait forever for them to stop
+        for thread in threads:
+            thread.join(timeout=10)
+
+
+def iterate_in_background(iterable, batch_size=1000, queue_size=10, metrics=None, tick=None, tick_interval=1):
+    '''
+    Consume `iterable` in a background thread and yield its items in the same order
+    (see `merge_in_background`).
+    '''
+    return merge_in_background(
+        [iterable], batch_size=batch_size, queue_size=queue_size, metrics=metrics, tick=tick, tick_interval=tick_interval
+    )
@@ -0,0 +1,146 @@
+import os
+import time
+import bisect
+import threading
+import contextlib
+import collections
+
+
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+SIZE_BUCKETS = [1, 10, 100, 1000, 10000, 100000, 1000000]
+
+
+def format_name(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}="{value}"' for key, value in sorted(labels.items())) + '}'
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is for values greater than all buckets
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class Metrics:
+    '''
+    Counters and histograms of an extract-load run, identified by a name and labels
+    (such as `stream`). They are updated by batches (and not by record) to keep overhead low
+    and may be updated from several threads.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.counters = collections.defaultdict(float)  # (name, labels) --> value
+        self.histograms = {}  # (name, labels) --> Histogram
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(buckets)
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def summary(self):
+        with self.lock:
+            summary = {'duration_seconds': round(time.monotonic() - self.started_at, 3)}
+            for (name, labels), value in sorted(self.counters.items()):
+                summary[format_name(name, dict(labels))] = round(value, 6)
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                summary[format_name(name, dict(labels))] = {
+                    'count': histogram.count,
+                    'sum': round(histogram.sum, 6),
+                    'avg': round(histogram.sum / histogram.count, 6) if histogram.count else 0,
+                    'max': round(histogram.max, 6),
+                }
+        return summary
+
+    def to_prometheus(self):
+        '''
+        Return metrics in Prometheus text exposition format
+        '''
+        lines = []
+        with self.lock:
+            lines.append('# TYPE abs_run_duration_seconds gauge')
+            lines.append(f'abs_run_duration_seconds {time.monotonic() - self.started_at}')
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append(f'# TYPE abs_{name} counter')
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append(f'{format_name("abs_" + name, dict(labels))} {value}')
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f'# TYPE abs_{name} histogram')
+                for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    cumulated_count = 0
+                    for bucket, count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                        cumulated_count += count
+                        lines.append(f'{format_name("abs_" + name + "_bucket", dict(labels, le=bucket))} {cumulated_count}')
+                    lines.append(f'{format_name("abs_" + name + "_sum", dict(labels))} {histogram.sum}')
+                    lines.append(f'{format_name("abs_" + name + "_count", dict(labels))} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, filename):
+        '''
+        Write metrics in `filename` for Prometheus node exporter textfile collector
+        '''
+        temp_filename = f'{filename}.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as file:
+            file.write(self.to_prometheus())
+        os.replace(temp_filename, filename)
+
+    def serve(self, port):
+        '''
+        Expose metrics at `http://localhost:{port}/metrics` from a background thread
+        '''
+        import http.server
+        import socketserver
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        server = Server(('', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,183 @@
+import os
+import sys
+import json
+import time
+import threading
+import collections
+
+
+PACKAGE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# Innermost function of airbyte_serverless found in a sampled stack --> stage
+STAGES = {
+    'iter_lines': 'connector wait',
+    'parse_message': 'json parse',
+    'parse_raw_record': 'json parse',
+    '_format_columns': 'format',
+    '_write': 'destination write',
+    '_commit': 'destination write',
+    'get_state': 'state query',
+    '_get_state_from_history': 'state query',
+    'merge_in_background': 'waiting for messages',
+    'load': 'load loop',
+}
+
+# Functions whose whole thread belongs to a stage, whatever is called inside
+THREAD_STAGES = {
+    'print_lines': 'connector stderr',
+}
+
+
+class SamplingProfiler:
+    '''
+    Sample stacks of all threads every `interval` seconds from a background thread.
+
+    Overhead is low since nothing is traced: only stacks are walked at each sample.
+    Samples are attributed to stages (connector wait, json parse, format, destination write, state query, ...)
+    with the innermost function of airbyte_serverless of the stack.
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = collections.Counter()  # (thread name, stack) --> count
+        self.stopped = threading.Event()
+        self.thread = None
+        self.duration = 0
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        self.thread = threading.Thread(target=self._sample_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.duration = time.perf_counter() - self.started_at
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _sample_forever(self):
+        own_thread_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stack.reverse()
+                self.samples[(thread_names.get(thread_id, str(thread_id)), tuple(stack))] += 1
+
+    @staticmethod
+    def get_stage(stack):
+        for function, filename, _ in stack:
+            if function in THREAD_STAGES and filename.startswith(PACKAGE_FOLDER):
+                return THREAD_STAGES[function]
+        for function, filename, _ in reversed(stack):
+            if function in STAGES and filename.startswith(PACKAGE_FOLDER):
+                return STAGES[function]
+        return 'other'
+
+    @property
+    def stages(self):
+        '''
+        Return seconds spent in each stage (summed over threads)
+        '''
+        stages = collections.Counter()
+        for (_, stack), count in self.samples.items():
+            stages[self.get_stage(stack)] += count * self.interval
+        return dict(stages.most_common())
+
+    def get_hot_functions(self, top=30):
+        '''
+        Return the `top` functions with the highest self time as (function, self seconds, total seconds)
+        '''
+        self_samples = collections.Counter()
+        total_samples = collections.Counter()
+        for (_, stack), count in self.samples.items():
+            if not stack:
+                continue
+            self_samples[stack[-1]] += count
+            for frame in set(stack):
+                total_samples[frame] += count
+        return [
+            (f'{function} ({os.path.basename(filename)}:{line})', count * self.interval, total_samples[(function, filename, line)] * self.interval)
+            for (function, filename, line), count in self_samples.most_common(top)
+        ]
+
+    def to_speedscope(self):
+        '''
+        Return samples in speedscope format (one sampled profile per thread), see https://www.speedscope.app
+        '''
+        frames = {}
+        profiles = {}
+        for (thread_name, stack), count in self.samples.items():
+            indexes = [frames.setdefault(frame, len(frames)) for frame in stack]
+            profile = profiles.setdefault(thread_name, {'samples': [], 'weights': []})
+            profile['samples'].append(indexes)
+            profile['weights'].append(count * self.interval)
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': 'airbyte_serverless run',
+            'shared': {
+                'frames': [
+                    {'name': function, 'file': filename, 'line': line}
+                    for (function, filename, line), _ in sorted(frames.items(), key=lambda item: item[1])
+                ],
+            },
+            'profiles': [
+                {
+                    'type': 'sampled',
+                    'name': thread_name,
+                    'unit': 'seconds',
+                    'startValue': 0,
+                    'endValue': sum(profile['weights']),
+                    'samples': profile['samples'],
+                    'weights': profile['weights'],
+                }
+                for thread_name, profile in profiles.items()
+            ],
+        }
+
+    def report(self, top=30):
+        lines = [f'Profile of {self.duration:.1f}s run (one sample every {self.interval * 1000:.0f}ms per thread)', '', 'STAGES']
+        lines += [f'  {stage:<25} {seconds:>10.2f}s' for stage, seconds in self.stages.items()]
+        lines += ['', f'TOP {top} FUNCTIONS BY SELF TIME', f'  {"FUNCTION":<70} {"SELF":>10} {"TOTAL":>10}']
+        lines += [f'  {function:<70} {self_seconds:>9.2f}s {total_seconds:>9.2f}s' for function, self_seconds, total_seconds in self.get_hot_functions(top)]
+        return '\n'.join(lines) + '\n'
+
+    def add_to_metrics(self, metrics, top=10):
+        for stage, seconds in self.stages.items():
+            metrics.increment('profile_stage_seconds', seconds, stage=stage)
+        for function, self_seconds, _ in self.get_hot_functions(top):
+            metrics.increment('profile_function_self_seconds', self_seconds, function=function)
+
+    def save(self, folder, gcs_prefix=None):
+        '''
+        Write speedscope file and text report in `folder` and upload them
+        to `gcs_prefix` (like `gs://bucket/folder`) if given. Return written files.
+        '''
+        os.makedirs(folder, exist_ok=True)
+        name = time.strftime('profile-%Y%m%d-%H%M%S')
+        filenames = [os.path.join(folder, f'{name}.speedscope.json'), os.path.join(folder, f'{name}.txt')]
+        with open(filenames[0], 'w', encoding='utf-8') as file:
+            json.dump(self.to_speedscope(), file)
+        with open(filenames[1], 'w', encoding='utf-8') as file:
+            file.write(self.report())
+        if gcs_prefix:
+            import google.cloud.storage
+            client = google.cloud.storage.Client()
+            for filename in list(filenames):
+                uri = f'{gcs_prefix.rstrip("/")}/{os.path.basename(filename)}'
+                google.cloud.storage.Blob.from_string(uri, client=client).upload_from_filename(filename)
+                filenames.append(uri)
+        return filenames
@@ -0,0 +1,175 @@
+import os
+import re
+import json
+import time
+
+from .cache import CACHE_FOLDER
+
+
+REGISTRY_URL = os.environ.get('ABS_REGISTRY_URL', 'https://connectors.airbyte.com/files/registries/v0/oss_registry.json')
+REGISTRY_TTL = 24 * 3600
+OFFLINE = os.environ.get('ABS_OFFLINE', '').lower() in ['1', 'true', 'yes']
+
+
+def get_pypi_package(source):
+    return source.get('remoteRegistries', {}).get('pypi', {}).get('packageName')
+
+
+def index_registry(registry):
+    '''
+    Return an index of `registry` sources keyed by connector name (such as `source-faker`)
+    with `packages` mapping PyPI package names (such as `airbyte-source-faker`) to connector names.
+    Only needed fields are kept so that the index is small and fast to load.
+    '''
+    connectors = {}
+    packages = {}
+    for source in registry.get('sources', []):
+        docker_repository = source.get('dockerRepository')
+        if not docker_repository:
+            continue
+        name = docker_repository.split('/')[-1]
+        pypi_package = get_pypi_package(source)
+        spec = source.get('spec') or {}
+        connectors[name] = {
+            'name': name,
+            'title': source.get('name', name),
+            'docker_repository': docker_repository,
+            'docker_image_tag': source.get('dockerImageTag'),
+            'pypi_package': pypi_package,
+            # PyPI packages of airbyte sources are published with the version of the docker image
+            'pypi_version': source.get('dockerImageTag') if pypi_package else None,
+            'supports_incremental': source.get('supportsIncremental', spec.get('supportsIncremental')),
+            'supports_refreshes': source.get('supportsRefreshes'),
+            'support_level': source.get('supportLevel'),
+            'documentation_url': source.get('documentationUrl') or spec.get('documentationUrl'),
+        }
+        if pypi_package:
+            packages[pypi_package] = name
+    return {'connectors': connectors, 'packages': packages}
+
+
+class ConnectorRegistry:
+    '''
+    Index of Airbyte sources of the OSS registry, stored on disk in `folder`.
+
+    The stored index is used as is during `ttl` seconds. After, the registry is revalidated
+    with `If-None-Match` / `If-Modified-Since` headers so that it is only downloaded again if it changed.
+    In `offline` mode, the stored index is used whatever its age and the registry is never requested.
+    '''
+
+    def __init__(self, url=REGISTRY_URL, folder=CACHE_FOLDER, ttl=REGISTRY_TTL, offline=OFFLINE):
+        self.url = url
+        self.filename = os.path.join(folder, 'registry-index.json')
+        self.ttl = ttl
+        self.offline = offline
+        self._entry = None
+
+    def _read(self):
+        try:
+            with open(self.filename, encoding='utf-8') as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get('url') == self.url else None
+
+    def _write(self, entry):
+        temp_filename = f'{self.filename}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(temp_filename, 'w', encoding='utf-8') as file:
+                json.dump(entry, file)
+            os.replace(temp_filename, self.filename)
+        except OSError as e:
+            print(f'Could not write registry index file {self.filename}: {e}')
+
+    def _fetch(self, entry):
+        '''
+        Request the registry (conditionally if `entry` is given) and return the new entry
+        '''
+        import requests
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        response = requests.get(self.url, headers=headers, timeout=30)
+        if response.status_code == 304 and entry:
+            return dict(entry, fetched_at=time.time())
+        response.raise_for_status()
+        return {
+            'url': self.url,
+            'fetched_at': time.time(),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'index': index_registry(response.json()),
+        }
+
+    def refresh(self, force=False):
+        '''
+        Revalidate the stored index if it is older than `ttl` (or if `force`) and return it
+        '''
+        entry = self._entry or self._read()
+        if self.offline:
+            assert entry, 'Connector registry has never been downloaded. Please run once without offline mode (`ABS_OFFLINE` env var)'
+        elif force or not entry or time.time() - entry.get('fetched_at', 0) > self.ttl:
+            try:
+                entry = self._fetch(entry)
+                self._write(entry)
+            except Exception as e:
+                if not entry:
+                    raise
+                print(f'Could not refresh connector registry ({e}). Using registry downloaded at {time.ctime(entry["fetched_at"])}')
+        self._entry = entry
+        return entry['index']
+
+    @property
+    def index(self):
+        if self._entry is None:
+            self.refresh()
+        return self._entry['index']
+
+    @property
+    def connectors(self):
+        return self.index['connectors']
+
+    def get(self, name):
+        '''
+        Return the connector of `name` which may be a connector name (`source-faker`),
+        a docker image (`airbyte/source-faker:0.1.4`) or a PyPI requirement (`airbyte-source-faker==0.1.4`)
+        '''
+        name = re.split('==|:', name.strip())[0].split('/')[-1]
+        name = self.index['packages'].get(name, name)
+        return self.connectors.get(name)
+
+    def search(self, text=''):
+        text = text.lower()
+        return [
+            connector for name, connector in sorted(self.connectors.items())
+            if text in name or text in connector['title'].lower() or text in (connector['pypi_package'] or '')
+        ]
+
+    @property
+    def python_sources(self):
+        return [
+            f"{connector['pypi_package']}=={connector['pypi_version']}"
+            for connector in self.connectors.values()
+            if connector['pypi_package']
+        ]
+
+
+def pin_source_version(source, version=None, registry=None):
+    '''
+    Return `source` (a docker image or an executable such as `pipx run airbyte-source-faker`)
+    with its connector version set to `version` (latest version of the `registry` if None)
+    '''
+    docker_image = re.search(r'(airbyte/source-[\w-]+)(:[\w.-]+)?', source)
+    package = re.search(r'(?<![\w/-])(airbyte-source-[\w-]+)(==[\w.-]+)?', source)
+    match = docker_image or package
+    assert match, f'No docker image (`airbyte/source-*`) or PyPI package (`airbyte-source-*`) found in source `{source}`'
+    if not version:
+        registry = registry or ConnectorRegistry()
+        connector = registry.get(match.group(1))
+        assert connector, f'`{match.group(1)}` was not found in connector registry'
+        version = connector['docker_image_tag'] if docker_image else connector['pypi_version']
+    separator = ':' if docker_image else '=='
+    return source[:match.start()] + f'{match.group(1)}{separator}{version}' + source[match.end():]
@@ -1,6 +1,46 @@
+import os
+import json
 import base64
+import subprocess
 
 from .version import VERSION
+from .messages import iterate_in_background, TICK_MESSAGE
+from .metrics import Metrics
+from .cache import hash_content
+
+
+RUNNER_IMAGE_DOCKERFILE = '''
+FROM {source_image}
+RUN pip install --no-cache-dir airbyte-serverless=={version}
+ENTRYPOINT []
+CMD ["abs", "run-env-vars"]
+'''.lstrip()
+
+
+def generate_runner_image_context(source_image, folder):
+    '''
+    Write in `folder` the Dockerfile of an image with airbyte_serverless installed
+    on top of `source_image` so that remote runs do not install it at start
+    '''
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, 'Dockerfile'), 'w', encoding='utf-8') as file:
+        file.write(RUNNER_IMAGE_DOCKERFILE.format(source_image=source_image, version=VERSION))
+    return folder
+
+
+def is_registry_image(tag):
+    '''
+    Return True if `tag` is a registry path (such as `REGION-docker.pkg.dev/PROJECT/REPOSITORY/IMAGE:TAG`
+    or `USER/IMAGE` on Docker Hub) and not only a local name which Cloud Run could not pull
+    '''
+    return '/' in tag
+
+
+def build_runner_image(folder, tag, push=False):
+    subprocess.run(['docker', 'build', '--tag', tag, folder], check=True)
+    if push:
+        subprocess.run(['docker', 'push', tag], check=True)
+
 
 class BaseRunner:
 
@@ -15,11 +55,33 @@ class BaseRunner:
 
 class DirectRunner(BaseRunner):
 
-    def run(self, state=None):
-        if state is None:
-            state = self.connection.destination.get_state()
-        messages = self.connection.source.extract(state=state)
-        self.connection.destination.load(messages)
+    def run(self, state=None, pipelined=True, metrics=None, profiler=None):
+        '''
+        Extract-load connection and return the number of loaded records.
+        Metrics of the run (and profile summary if a `profiler` is given) are written to destination logs at the end.
+        '''
+        metrics = metrics or Metrics()
+        if profiler is not None:
+            profiler.start()
+        try:
+            destination = self.connection.destination
+            if state is None:
+                with metrics.timer('get_state_seconds'):
+                    state = destination.get_state()
+            messages = self.connection.source.extract(state=state, raw=True, metrics=metrics)
+            if pipelined:
+                # Extract in a background thread while destination is writing.
+                # Messages keep their order so states are still written after their records.
+                # Ticks wake the destination up when the source is slow so that old buffers are written on time.
+                messages = iterate_in_background(messages, metrics=metrics, tick=TICK_MESSAGE)
+            destination.load(messages, configured_catalog=self.connection.source.configured_catalog, metrics=metrics)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+        if profiler is not None:
+            profiler.add_to_metrics(metrics)
+        destination.write_metrics()
+        return destination.records_count
 
 
 class CloudRunJobRunner(BaseRunner):
@@ -29,23 +91,45 @@ class CloudRunJobRunner(BaseRunner):
         'region: "europe-west1" # REQUIRED | string | Region where cloud run job will be deployed',
         'service_account: "" # OPTIONAL | string | Service account email used bu Cloud Run Job. If empty default compute service account will be used',
         'env_vars:  # OPTIONAL | dict | Environements Variables',
+        'ship_catalog: false # OPTIONAL | boolean | If true, the source catalog is discovered once at deploy time and shipped with the job so that remote runs skip `discover`',
+        'runner_image: "" # OPTIONAL | string | Image with airbyte_serverless installed on top of the source image, generated by `abs build-runner-image`. If empty, airbyte_serverless is installed at the start of each run',
+        'task_count: 1 # OPTIONAL | integer | Number of Cloud Run tasks. Streams are split between tasks which run in parallel. Requires a source with per-stream states (tasks fail otherwise)',
     ])
 
+    spec_hash_label = 'abs-spec-hash'
+
+    def __init__(self, connection, jobs_client=None):
+        super().__init__(connection)
+        self._jobs_client = jobs_client  # May be given to use another client than `google.cloud.run_v2.JobsClient` (e.g. in tests)
+
+    @property
+    def jobs_client(self):
+        if self._jobs_client is None:
+            import google.cloud.run_v2
+            self._jobs_client = google.cloud.run_v2.JobsClient()
+        return self._jobs_client
+
     def run(self):
-        import google.cloud.run_v2
-        import google.api_core.exceptions
-        cloud_run = google.cloud.run_v2.JobsClient()
+        cloud_run = self.jobs_client
 
         runner_config = self.connection.config['remote_runner']['config']
-        docker_image = runner_config.get('image') or self.connection.config['source']['docker_image']
-        command = runner_config.get('command') or ["/bin/sh"]
-        args = runner_config.get('args') or ['-c', f'pip install airbyte-serverless=={VERSION} && abs run-env-vars']
+        runner_image = runner_config.get('runner_image')
+        if runner_image:
+            docker_image = runner_image
+            command = runner_config.get('command') or ['abs']
+            args = runner_config.get('args') or ['run-env-vars']
+        else:
+            docker_image = runner_config.get('image') or self.connection.config['source']['docker_image']
+            command = runner_config.get('command') or ["/bin/sh"]
+            args = runner_config.get('args') or ['-c', f'pip install airbyte-serverless=={VERSION} && abs run-env-vars']
         project = runner_config['project']
         region = runner_config['region']
         memory = runner_config.get('memory', '1024Mi')
         cpu = str(runner_config.get('cpu', 1))
         timeout = runner_config.get('timeout', '86400s')
         max_retries = runner_config.get('max_retries', 0)
+        task_count = int(runner_config.get('task_count') or 1)
+        parallelism = int(runner_config.get('parallelism') or 0)  # 0 means all tasks at once
 
 
         assert project, 'Project is null in connection yaml file (under remote_runner field). Please fill it'
@@ -57,6 +141,10 @@ class CloudRunJobRunner(BaseRunner):
             assert isinstance(env_vars, dict), "Given env_vars argument should be a dict"
             env = [{'name': k, 'value': v} for k, v in env_vars.items()]
         yaml_config_b64 = base64.b64encode(self.connection.yaml_config.encode('utf-8')).decode('utf-8')
+        if runner_config.get('ship_catalog'):
+            catalog = json.dumps(self.connection.source.catalog)
+            catalog_b64 = base64.b64encode(catalog.encode('utf-8')).decode('utf-8')
+            env.append({'name': 'AIRBYTE_CATALOG', 'value': catalog_b64})
 
         location = f"projects/{project}/locations/{region}"
         job_id = f'abs-{self.connection.name}'.lower().replace('_', '-')
@@ -82,21 +170,38 @@ class CloudRunJobRunner(BaseRunner):
         if service_account:
             job_config['service_account'] = service_account
 
-        try:
-            cloud_run.delete_job(name=job_name).result()
-        except google.api_core.exceptions.NotFound:
-            pass
-        cloud_run.create_job(
-            job={'template': {'template': job_config}},
-            job_id=job_id,
-            parent=location,
-        ).result()
+        job = {'template': {'template': job_config, 'task_count': task_count, 'parallelism': parallelism}}
+        self.deploy_job(job, job_id, location)
         operation = cloud_run.run_job({'name': job_name})
         execution_id = operation.metadata.name.split('/')[-1]
         execution_url = f'https://console.cloud.google.com/run/jobs/executions/details/{region}/{execution_id}/logs?project={project}'
         print('Launched Job. See details at', execution_url)
         operation.result()
 
+    def deploy_job(self, job, job_id, location):
+        '''
+        Create job if it does not exist or update it if its spec changed.
+
+        The hash of the spec is stored as a job label so that unchanged jobs are left
+        untouched (and keep their executions history).
+        '''
+        import google.api_core.exceptions
+        cloud_run = self.jobs_client
+        job_name = f'{location}/jobs/{job_id}'
+        spec_hash = hash_content(job)[:63]  # Label values are limited to 63 characters
+        try:
+            existing_job = cloud_run.get_job(name=job_name)
+        except google.api_core.exceptions.NotFound:
+            existing_job = None
+        job = dict(job, labels={self.spec_hash_label: spec_hash})
+        if existing_job is None:
+            print('Creating job', job_name)
+            cloud_run.create_job(job=job, job_id=job_id, parent=location).result()
+        elif dict(existing_job.labels).get(self.spec_hash_label) != spec_hash:
+            print('Updating job', job_name)
+            labels = dict(dict(existing_job.labels), **job['labels'])
+            cloud_run.update_job(job=dict(job, name=job_name, labels=labels)).result()
+
 
 RUNNER_CLASS_MAP = {
     'direct': DirectRunner,
@@ -1,67 +1,125 @@
+import os
 import re
+import signal
 import tempfile
 import subprocess
 import json
 import shutil
 
-import requests
-
-from . import airbyte_utils
-
-AVAILABLE_PYTHON_SOURCES_URL = 'https://connectors.airbyte.com/files/registries/v0/oss_registry.json'
-AVAILABLE_PYTHON_SOURCES = []
+from . import messages as airbyte_messages
+from .cache import Cache, CACHE_TTL, hash_content
+from .registry import ConnectorRegistry
 
 
 def get_available_python_sources():
-    if AVAILABLE_PYTHON_SOURCES:
-        return AVAILABLE_PYTHON_SOURCES
-    resp = requests.get(AVAILABLE_PYTHON_SOURCES_URL)
-    res = resp.json()
-    sources = res['sources']
-    python_sources = [
-        f"{source.get('remoteRegistries', {}).get('pypi', {}).get('packageName')}=={source['dockerImageTag']}"
-        for source in sources
-        if source.get('remoteRegistries', {}).get('pypi', {}).get('packageName') is not None
-    ]
-    AVAILABLE_PYTHON_SOURCES.extend(python_sources)
-    return python_sources
+    return ConnectorRegistry().python_sources
 
 
 class AirbyteSourceException(Exception):
     pass
 
 
+def get_streams_state(state, streams):
+    '''
+    Return the part of `state` (as returned by `destination.get_state`) which concerns `streams`
+    '''
+    if not state:
+        return state
+    if isinstance(state, list):
+        if any(stream_state.get('type') == 'GLOBAL' for stream_state in state):
+            raise AirbyteSourceException('Parallel extraction is not possible with a GLOBAL state. Please set `parallelism` to 1')
+        return [
+            stream_state for stream_state in state
+            if stream_state.get('stream', {}).get('stream_descriptor', {}).get('name') in streams
+        ]
+    # Legacy states are keyed by stream
+    return {stream: stream_state for stream, stream_state in state.items() if stream in streams}
+
+
+def merge_legacy_states(messages, state=None):
+    '''
+    Yield `messages` of parallel extracts where legacy states (which only contain the streams
+    of the extract which emitted them) are merged with the latest legacy states of other extracts.
+    STREAM states are left untouched since they are already merged by the destination.
+    '''
+    legacy_data = dict(state) if isinstance(state, dict) else {}
+    for message in messages:
+        if message['type'] == 'STATE':
+            state = message['state']
+            if state.get('type') == 'GLOBAL':
+                raise AirbyteSourceException('Parallel extraction is not possible with a source emitting GLOBAL states. Please set `parallelism` to 1')
+            if state.get('type') != 'STREAM' and isinstance(state.get('data'), dict):
+                legacy_data.update(state['data'])
+                message = {'type': 'STATE', 'state': {**state, 'data': dict(legacy_data)}}
+        yield message
+
+
+STREAM_STATES_ONLY_ERROR = (
+    'Streams are split between several tasks (`task_count` > 1) which is only possible '
+    'for sources with per-stream (STREAM) states. Please set `task_count` to 1'
+)
+
+
+def check_stream_states(messages, state=None):
+    '''
+    Yield `messages`, raising if `state` or an emitted STATE is not a per-stream state.
+    GLOBAL and legacy states of an extract of some streams would overwrite states of other streams.
+    '''
+    if isinstance(state, dict) and state or isinstance(state, list) and any(stream_state.get('type') != 'STREAM' for stream_state in state):
+        raise AirbyteSourceException(STREAM_STATES_ONLY_ERROR)
+    for message in messages:
+        if message['type'] == 'STATE' and message['state'].get('type') != 'STREAM':
+            raise AirbyteSourceException(STREAM_STATES_ONLY_ERROR)
+        yield message
+
+
 class ExecutableAirbyteSource:
 
-    def __init__(self, executable=None, config=None, streams=None):
+    def __init__(self, executable=None, config=None, streams=None, cache_ttl=CACHE_TTL, catalog=None, parallelism=1, destination_sync_mode='append', stream_states_only=False):
         self.executable = executable
         self.config = config
         self.streams = [stream.strip() for stream in streams.split(',')] if isinstance(streams, str) else streams
+        assert parallelism == 'all' or int(parallelism) >= 1, '`parallelism` must be a positive integer or `all`'
+        self.parallelism = parallelism
+        assert destination_sync_mode in ['append', 'append_dedup'], '`destination_sync_mode` must be `append` or `append_dedup`'
+        self.destination_sync_mode = destination_sync_mode
+        self.cache = Cache(ttl=cache_ttl)
+        self._catalog = catalog  # May be given to skip `discover` (e.g. when shipped to a remote runner)
+        self.stream_states_only = stream_states_only  # Set when other streams are extracted by other processes (e.g. other Cloud Run tasks)
         self.temp_dir_obj = tempfile.TemporaryDirectory()  # Used to dump config as files used by airbyte connector
         self.temp_dir = self.temp_dir_obj.name
         self.temp_dir_for_executable = self.temp_dir  # May be different if executable is a docker image where temp dir is mounted elsewhere
 
+    def close(self):
+        self.temp_dir_obj.cleanup()
+
     @property
     def yaml_definition_example(self):
         return '\n'.join([
             f'executable: "{self.executable}" # GENERATED | string | Command to launch the Airbyte Source',
             'config: ' + self.yaml_config_example.replace('\n', '\n  ').strip(),
             'streams: # OPTIONAL | string | Comma-separated list of streams to retrieve. If missing, all streams are retrieved from source.',
+            f'cache_ttl: {CACHE_TTL} # OPTIONAL | integer | Number of seconds during which spec and catalog of the source are cached on disk. Set to 0 to disable cache. Use `abs refresh-catalog` to invalidate cache.',
+            'destination_sync_mode: "append" # OPTIONAL | string | `append` or `append_dedup`. With `append_dedup`, incremental streams with a primary key are also deduplicated on their primary key in final tables (only supported by `bigquery` destination)',
+            'parallelism: 1 # OPTIONAL | integer or "all" | Number of connector processes extracting streams in parallel (streams are split into this number of groups). Set to `all` to run one process per stream.',
         ])
 
     @property
     def yaml_config_example(self):
+        from . import airbyte_utils
         spec = self.spec
         return airbyte_utils.generate_connection_yaml_config_sample(spec)
 
-    def _run(self, action, state=None):
+    def _run(self, action, state=None, raw=False, configured_catalog=None, metrics=None):
         assert self.executable, '`executable` attribute should be set'
         command = f'{self.executable} {action}'
 
         def add_argument(name, value):
-            with open(f'{self.temp_dir}/{name}.json', 'w', encoding='utf-8') as file:
+            # Files are unique per run since several runs may be launched in parallel
+            fd, filename = tempfile.mkstemp(prefix=f'{name}-', suffix='.json', dir=self.temp_dir)
+            with open(fd, 'w', encoding='utf-8') as file:
                 json.dump(value, file)
-            return f' --{name} {self.temp_dir_for_executable}/{name}.json'
+            return f' --{name} {self.temp_dir_for_executable}/{os.path.basename(filename)}'
 
         needs_config = (action != 'spec')
         if needs_config:
@@ -70,22 +128,30 @@ class ExecutableAirbyteSource:
 
         needs_configured_catalog = (action == 'read')
         if needs_configured_catalog:
-            command += add_argument('catalog', self.configured_catalog)
+            command += add_argument('catalog', configured_catalog or self.configured_catalog)
 
         if state:
             command += add_argument('state', state)
 
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-        for line in iter(process.stdout.readline, b""):
-            content = line.decode().strip()
-            try:
-                message = json.loads(content)
-            except:
-                print('NOT JSON:', content)
-                continue
-            if message.get('trace', {}).get('error'):
-                raise AirbyteSourceException(json.dumps(message['trace']['error']))
-            yield message
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, start_new_session=True
+        )
+        stderr_thread = airbyte_messages.start_draining(process.stderr)
+        completed = False
+        try:
+            for message in airbyte_messages.read_messages(process.stdout, raw=raw, metrics=metrics):
+                if message.get('type') == 'TRACE' and message.get('trace', {}).get('error'):
+                    raise AirbyteSourceException(json.dumps(message['trace']['error']))
+                yield message
+            completed = True
+        finally:
+            if not completed and process.poll() is None:
+                # Connector output is not consumed anymore: kill the shell and its children
+                os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+            stderr_thread.join()
+            process.stdout.close()
+            process.stderr.close()
 
     def _run_and_return_first_message(self, action):
         messages = self._run(action)
@@ -98,10 +164,36 @@ class ExecutableAirbyteSource:
             return message
         assert False, f'No message returned by AirbyteSource with action `{action}`'
 
+    @property
+    def executable_digest(self):
+        if not hasattr(self, '_executable_digest'):
+            executable = self.executable.split(' ')[0]
+            path = shutil.which(executable)
+            stat = os.stat(path) if path else None
+            self._executable_digest = hash_content([
+                self.executable,
+                path,
+                stat and stat.st_size,
+                stat and stat.st_mtime,
+            ])
+        return self._executable_digest
+
+    @property
+    def spec_cache_key(self):
+        return f'spec-{self.executable_digest}'
+
+    @property
+    def catalog_cache_key(self):
+        return f'catalog-{hash_content([self.executable_digest, self.config])}'
+
     @property
     def spec(self):
-        message = self._run_and_return_first_message('spec')
-        return message['spec']
+        spec = self.cache.get(self.spec_cache_key)
+        if spec is None:
+            message = self._run_and_return_first_message('spec')
+            spec = message['spec']
+            self.cache.set(self.spec_cache_key, spec)
+        return spec
 
     @property
     def config_spec(self):
@@ -115,17 +207,32 @@ class ExecutableAirbyteSource:
 
     @property
     def catalog(self):
-        message = self._run_and_return_first_message('discover')
-        return message['catalog']
+        if self._catalog is None:
+            self._catalog = self.cache.get(self.catalog_cache_key)
+        if self._catalog is None:
+            message = self._run_and_return_first_message('discover')
+            self._catalog = message['catalog']
+            self.cache.set(self.catalog_cache_key, self._catalog)
+        return self._catalog
+
+    def refresh_catalog(self):
+        self.cache.delete(self.spec_cache_key)
+        self.cache.delete(self.catalog_cache_key)
+        self._catalog = None
+        return self.catalog
 
     @property
     def configured_catalog(self):
-        configured_catalog = self.catalog
+        configured_catalog = dict(self.catalog)
         configured_catalog['streams'] = [
             {
                 "stream": stream,
                 "sync_mode": "incremental" if 'incremental' in stream['supported_sync_modes'] else 'full_refresh',
-                "destination_sync_mode": "append",
+                "destination_sync_mode": (
+                    "append_dedup"
+                    if self.destination_sync_mode == 'append_dedup' and 'incremental' in stream['supported_sync_modes'] and stream.get('source_defined_primary_key')
+                    else "append"
+                ),
                 "cursor_field": stream.get('default_cursor_field', [])
             }
             for stream in configured_catalog['streams']
@@ -147,19 +254,56 @@ class ExecutableAirbyteSource:
         message = self._run_and_return_first_message('read')
         return message['record']
 
-    def extract(self, state=None):
-        return self._run('read', state=state)
+    @property
+    def stream_groups(self):
+        '''
+        Configured streams split into `parallelism` groups (one group per stream if `parallelism` is `all`)
+        '''
+        streams = self.configured_catalog['streams']
+        count = len(streams) if self.parallelism == 'all' else int(self.parallelism)
+        count = max(min(count, len(streams)), 1)
+        return [streams[number::count] for number in range(count)]
+
+    def extract(self, state=None, raw=False, metrics=None):
+        messages = self._extract(state=state, raw=raw, metrics=metrics)
+        if self.stream_states_only:
+            messages = check_stream_states(messages, state=state)
+        return messages
+
+    def _extract(self, state=None, raw=False, metrics=None):
+        stream_groups = self.stream_groups
+        if len(stream_groups) == 1:
+            return self._run('read', state=state, raw=raw, metrics=metrics)
+        # One connector process per group of streams, each one with the state of its streams
+        extracts = []
+        for streams in stream_groups:
+            configured_catalog = dict(self.configured_catalog, streams=streams)
+            streams_state = get_streams_state(state, [stream['stream']['name'] for stream in streams])
+            extracts.append(self._run('read', state=streams_state, raw=raw, configured_catalog=configured_catalog, metrics=metrics))
+        return merge_legacy_states(airbyte_messages.merge_in_background(extracts), state=state)
 
 
 class DockerAirbyteSource(ExecutableAirbyteSource):
 
-    def __init__(self, connector=None, config=None, streams=None):
+    def __init__(self, connector=None, config=None, streams=None, **kwargs):
         assert shutil.which('docker') is not None, 'docker is needed. Please install it'
         self.docker_image = connector
-        super().__init__('', config, streams)
+        super().__init__('', config, streams, **kwargs)
         self.temp_dir_for_executable = '/mnt/temp'
         self.executable = f'docker run --rm -i --volume {self.temp_dir}:{self.temp_dir_for_executable} {self.docker_image}'
 
+    @property
+    def executable_digest(self):
+        if not hasattr(self, '_executable_digest'):
+            process = subprocess.run(
+                ['docker', 'image', 'inspect', '--format', '{{.Id}}', self.docker_image],
+                capture_output=True,
+            )
+            image_id = process.stdout.decode().strip() if process.returncode == 0 else ''
+            # When image is not pulled yet, its tag is the best identifier we have
+            self._executable_digest = hash_content(image_id or self.docker_image)
+        return self._executable_digest
+
     @property
     def yaml_definition_example(self):
         yaml_definition_example = super().yaml_definition_example
@@ -172,7 +316,7 @@ class DockerAirbyteSource(ExecutableAirbyteSource):
 
 class Source:
 
-    def __init__(self, docker_image_or_executable=None, docker_image=None, executable=None, config=None, streams=None):
+    def __init__(self, docker_image_or_executable=None, docker_image=None, executable=None, config=None, streams=None, **kwargs):
         if docker_image_or_executable:
             if re.match('^airbyte/source-[a-zA-Z-]+:?[\w\.]*$', docker_image_or_executable):
                 docker_image = docker_image_or_executable
@@ -180,9 +324,9 @@ class Source:
                 executable = docker_image_or_executable
 
         if executable:
-            self.source = ExecutableAirbyteSource(executable, config, streams)
+            self.source = ExecutableAirbyteSource(executable, config, streams, **kwargs)
         elif docker_image:
-            self.source = DockerAirbyteSource(docker_image, config, streams)
+            self.source = DockerAirbyteSource(docker_image, config, streams, **kwargs)
         else:
             raise Exception('One of the following arguments must be provided: `docker_image_or_executable`, `docker_image` or `executable`')
 
@@ -0,0 +1,79 @@
+'''
+Check that the CLI starts fast: `abs list` must not import heavy dependencies
+(google, grpc, requests, jinja2, yaml, ...) and must import within a time budget.
+
+Import time is measured with `python -X importtime` in a fresh process (the best of
+several runs is kept to reduce noise). Exit code is 1 if the check fails:
+
+    python benchmarks/import_time.py --budget-ms 150
+'''
+import os
+import sys
+import argparse
+import subprocess
+
+
+PACKAGE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that only some code paths need and which must be imported lazily
+FORBIDDEN_MODULES = ['google', 'grpc', 'requests', 'jinja2', 'yaml', 'pyarrow', 'duckdb', 'http.server']
+
+IMPORT_STATEMENT = 'import airbyte_serverless.cli'
+
+
+def measure_import():
+    '''
+    Return (cumulative import time in ms, {module: cumulative ms}) of `IMPORT_STATEMENT`
+    '''
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', IMPORT_STATEMENT],
+        stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, cwd=PACKAGE_FOLDER, check=True,
+    )
+    modules = {}
+    for line in process.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        modules[module.strip()] = int(cumulative) / 1000
+    return modules['airbyte_serverless.cli'], modules
+
+
+def get_imported_forbidden_modules():
+    process = subprocess.run(
+        [sys.executable, '-c', f'{IMPORT_STATEMENT}; import sys; print("\\n".join(sys.modules))'],
+        stdout=subprocess.PIPE, cwd=PACKAGE_FOLDER, check=True,
+    )
+    imported = process.stdout.decode().split()
+    return sorted({
+        module for module in FORBIDDEN_MODULES
+        if any(name == module or name.startswith(module + '.') for name in imported)
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check import time of airbyte_serverless CLI')
+    parser.add_argument('--budget-ms', type=float, default=150, help='Maximum import time of the CLI in milliseconds')
+    parser.add_argument('--runs', type=int, default=5, help='Number of measures (the best one is kept)')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest modules to print')
+    args = parser.parse_args()
+
+    measures = [measure_import() for _ in range(args.runs)]
+    duration, modules = min(measures, key=lambda measure: measure[0])
+    print(f'{IMPORT_STATEMENT}: {duration:.1f}ms (budget: {args.budget_ms:.0f}ms)\n')
+    print(f'{"MODULE":<50} {"CUMULATIVE":>12}')
+    for module, module_duration in sorted(modules.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'{module:<50} {module_duration:>10.1f}ms')
+
+    errors = []
+    if duration > args.budget_ms:
+        errors.append(f'import time {duration:.1f}ms exceeds budget of {args.budget_ms:.0f}ms')
+    forbidden_modules = get_imported_forbidden_modules()
+    if forbidden_modules:
+        errors.append(f'heavy modules imported at startup: {", ".join(forbidden_modules)}')
+    for error in errors:
+        print(f'\nERROR: {error}')
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+'''
+Measure airbyte_serverless overhead with the synthetic source (no network needed).
+
+Each scenario is run for each destination in its own process and results
+(records/s, bytes/s, CPU time and peak RSS) are written to a JSON file
+so that versions can be compared:
+
+    python benchmarks/run.py --output results/new.json --compare results/old.json
+'''
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from airbyte_serverless.version import VERSION
+from airbyte_serverless.metrics import Metrics
+from airbyte_serverless.connections import Connection
+from airbyte_serverless.destinations import BaseDestination, DESTINATION_CLASS_MAP
+
+
+SYNTHETIC_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'synthetic_source.py')
+
+SCENARIOS = {
+    'narrow': {'streams': 1, 'records': 200000, 'width': 5, 'field_size': 10, 'state_every': 10000},
+    'wide': {'streams': 1, 'records': 50000, 'width': 100, 'field_size': 20, 'state_every': 10000},
+    'many_streams_interleaved': {'streams': 20, 'records': 10000, 'width': 10, 'field_size': 10, 'interleave': True, 'state_every': 5000},
+    'chatty_states': {'streams': 1, 'records': 100000, 'width': 10, 'field_size': 10, 'state_every': 100},
+    'noisy_logs': {'streams': 1, 'records': 100000, 'width': 10, 'field_size': 10, 'state_every': 10000, 'log_every': 100},
+}
+
+
+class NullDestination(BaseDestination):
+    '''
+    Destination discarding formatted records to measure everything but the write
+    '''
+
+    def get_state(self):
+        return {}
+
+    def _write(self, record_type, records):
+        pass
+
+
+DESTINATION_CLASS_MAP['null'] = NullDestination
+
+
+def get_available_destinations():
+    destinations = ['null']
+    for destination, module in [('parquet', 'pyarrow'), ('duckdb', 'duckdb')]:
+        try:
+            __import__(module)
+            destinations.append(destination)
+        except ImportError:
+            pass
+    return destinations
+
+
+def run_scenario(scenario, destination):
+    folder = tempfile.mkdtemp(prefix='abs-benchmark-')
+    destination_config = {
+        'null': {},
+        'parquet': {'folder': folder},
+        'duckdb': {'database': os.path.join(folder, 'benchmark.duckdb')},
+    }[destination]
+    connection = Connection({
+        'source': {'executable': f'{sys.executable} {SYNTHETIC_SOURCE}', 'config': SCENARIOS[scenario], 'cache_ttl': 0},
+        'destination': {'connector': destination, 'config': destination_config},
+        'remote_runner': {'type': 'direct', 'config': {}},
+    })
+    metrics = Metrics()
+    start = time.perf_counter()
+    with connection:
+        records = connection.run(metrics=metrics)
+    duration = time.perf_counter() - start
+    own_usage = resource.getrusage(resource.RUSAGE_SELF)
+    connector_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    source_bytes = metrics.summary().get('source_bytes', 0)
+    return {
+        'scenario': scenario,
+        'destination': destination,
+        'records': records,
+        'duration_seconds': round(duration, 3),
+        'records_per_second': round(records / duration),
+        'bytes_per_second': round(source_bytes / duration),
+        'cpu_seconds': round(own_usage.ru_utime + own_usage.ru_stime, 3),
+        'connector_cpu_seconds': round(connector_usage.ru_utime + connector_usage.ru_stime, 3),
+        'peak_rss_mb': round(own_usage.ru_maxrss / 1024, 1),  # ru_maxrss is in KB on linux
+    }
+
+
+def compare(results, previous_results):
+    previous = {(result['scenario'], result['destination']): result for result in previous_results['results']}
+    print(f'\n{"SCENARIO":<28} {"DESTINATION":<12} {"RECORDS/S":>12} {"PREVIOUS":>12} {"RATIO":>7}')
+    for result in results['results']:
+        old = previous.get((result['scenario'], result['destination']))
+        old_speed = old['records_per_second'] if old else None
+        ratio = f'{result["records_per_second"] / old_speed:.2f}' if old_speed else '-'
+        print(f'{result["scenario"]:<28} {result["destination"]:<12} {result["records_per_second"]:>12} {old_speed or "-":>12} {ratio:>7}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark airbyte_serverless with a synthetic source')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma-separated list of scenarios')
+    parser.add_argument('--destinations', default=','.join(get_available_destinations()), help='Comma-separated list of destinations')
+    parser.add_argument('--output', default=f'benchmarks/results/{VERSION}.json', help='JSON file where results are written')
+    parser.add_argument('--compare', default='', help='JSON results file of a previous run to compare with')
+    parser.add_argument('--child', nargs=2, metavar=('SCENARIO', 'DESTINATION'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # Run in its own process so that CPU time and peak RSS are those of the scenario only
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                result = run_scenario(*args.child)
+            finally:
+                sys.stdout = stdout
+        print(json.dumps(result))
+        return
+
+    results = {'version': VERSION, 'python': sys.version.split()[0], 'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': []}
+    for scenario in args.scenarios.split(','):
+        for destination in args.destinations.split(','):
+            process = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), '--child', scenario, destination],
+                stdout=subprocess.PIPE, check=True,
+            )
+            result = json.loads(process.stdout.decode().strip().splitlines()[-1])
+            results['results'].append(result)
+            print(json.dumps(result))
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    print(f'Results written to {args.output}')
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
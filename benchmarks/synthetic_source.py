@@ -0,0 +1,116 @@
+'''
+Synthetic Airbyte source speaking the Airbyte protocol (spec, check, discover, read).
+
+Records are generated from the config:
+- `streams`: number of streams
+- `records`: number of records per stream
+- `width`: number of fields per record
+- `field_size`: number of characters of string fields
+- `interleave`: if true, streams are emitted in round robin instead of one after another
+- `state_every`: a STATE message is emitted every `state_every` records (per stream states)
+- `log_every`: a LOG message is emitted every `log_every` records (0 for no log)
+
+Usage: python synthetic_source.py read --config config.json --catalog catalog.json [--state state.json]
+'''
+import sys
+import json
+import time
+import argparse
+
+
+SPEC = {
+    'documentationUrl': 'https://github.com/unytics/airbyte_serverless',
+    'connectionSpecification': {
+        '$schema': 'http://json-schema.org/draft-07/schema#',
+        'title': 'Synthetic Source Spec',
+        'type': 'object',
+        'properties': {
+            'streams': {'type': 'integer', 'default': 1, 'description': 'Number of streams'},
+            'records': {'type': 'integer', 'default': 100000, 'description': 'Number of records per stream'},
+            'width': {'type': 'integer', 'default': 10, 'description': 'Number of fields per record'},
+            'field_size': {'type': 'integer', 'default': 10, 'description': 'Number of characters of string fields'},
+            'interleave': {'type': 'boolean', 'default': False, 'description': 'Emit streams in round robin'},
+            'state_every': {'type': 'integer', 'default': 10000, 'description': 'Number of records between states'},
+            'log_every': {'type': 'integer', 'default': 0, 'description': 'Number of records between logs'},
+        },
+    },
+}
+
+
+def get_stream_names(config):
+    return [f'stream_{number}' for number in range(config.get('streams', 1))]
+
+
+def get_catalog(config):
+    properties = {'id': {'type': 'integer'}, 'updated_at': {'type': 'string', 'format': 'date-time'}}
+    for number in range(config.get('width', 10) - 2):
+        properties[f'field_{number}'] = {'type': ['null', 'string']} if number % 2 else {'type': ['null', 'integer']}
+    return {
+        'streams': [
+            {
+                'name': name,
+                'json_schema': {'type': 'object', 'properties': properties},
+                'supported_sync_modes': ['full_refresh', 'incremental'],
+                'source_defined_cursor': True,
+                'default_cursor_field': ['updated_at'],
+                'source_defined_primary_key': [['id']],
+            }
+            for name in get_stream_names(config)
+        ]
+    }
+
+
+def generate_record(config, index):
+    record = {'id': index, 'updated_at': '2024-01-01T00:00:00Z'}
+    field_value = 'x' * config.get('field_size', 10)
+    for number in range(config.get('width', 10) - 2):
+        record[f'field_{number}'] = field_value if number % 2 else index * number
+    return record
+
+
+def read(config, catalog, state):
+    streams = [configured_stream['stream']['name'] for configured_stream in catalog['streams']]
+    start_indexes = {
+        stream_state['stream']['stream_descriptor']['name']: stream_state['stream']['stream_state']['id']
+        for stream_state in (state if isinstance(state, list) else [])
+    }
+    records = config.get('records', 100000)
+    state_every = config.get('state_every', 10000)
+    log_every = config.get('log_every', 0)
+    emitted_at = int(time.time() * 1000)
+    if config.get('interleave'):
+        order = ((stream, index) for index in range(records) for stream in streams)
+    else:
+        order = ((stream, index) for stream in streams for index in range(records))
+    write = sys.stdout.write
+    for stream, index in order:
+        if index < start_indexes.get(stream, 0):
+            continue
+        write(json.dumps({'type': 'RECORD', 'record': {'stream': stream, 'data': generate_record(config, index), 'emitted_at': emitted_at}}) + '\n')
+        if log_every and index % log_every == 0:
+            write(json.dumps({'type': 'LOG', 'log': {'level': 'INFO', 'message': f'{stream}: {index} records read'}}) + '\n')
+        if state_every and (index + 1) % state_every == 0 or index + 1 == records:
+            write(json.dumps({'type': 'STATE', 'state': {'type': 'STREAM', 'stream': {'stream_descriptor': {'name': stream}, 'stream_state': {'id': index + 1}}}}) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('action', choices=['spec', 'check', 'discover', 'read'])
+    parser.add_argument('--config')
+    parser.add_argument('--catalog')
+    parser.add_argument('--state')
+    args = parser.parse_args()
+    load = lambda filename: json.load(open(filename, encoding='utf-8')) if filename else None
+    config = load(args.config) or {}
+    if args.action == 'spec':
+        print(json.dumps({'type': 'SPEC', 'spec': SPEC}))
+    elif args.action == 'check':
+        print(json.dumps({'type': 'CONNECTION_STATUS', 'connectionStatus': {'status': 'SUCCEEDED'}}))
+    elif args.action == 'discover':
+        print(json.dumps({'type': 'CATALOG', 'catalog': get_catalog(config)}))
+    else:
+        read(config, load(args.catalog), load(args.state) or {})
+
+
+if __name__ == '__main__':
+    main()
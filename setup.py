@@ -31,7 +31,9 @@ setuptools.setup(
     python_requires='>=3.6',
     install_requires=[
         'google-cloud-bigquery',
+        'google-cloud-bigquery-storage',
         'google-cloud-run',
+        'google-cloud-storage',
         'google-cloud-secret-manager',
         'pyyaml',
         'jinja2',
@@ -39,6 +41,10 @@ setuptools.setup(
         'click-help-colors',
         'pipx',
     ],
+    extras_require={
+        'parquet': ['pyarrow'],
+        'duckdb': ['duckdb', 'pyarrow'],
+    },
     entry_points={
         'console_scripts': [
             'abs = airbyte_serverless.cli:cli',